@@ -0,0 +1,281 @@
+"""
+Benchmark the image optimization pipeline on a synthetic corpus.
+
+Usage: python benchmark_images.py [--quick] [--configs default,budget] [--repeat N]
+
+The corpus covers several resolutions, JPEG/PNG/TIFF/BMP/GIF, images
+with and without alpha, and JPEGs with an EXIF orientation. It is
+generated once into a temporary folder and reused. Each configuration
+runs in a fresh process so its peak memory can be measured.
+
+The script reports throughput, p50/p95 latency, peak RSS and the
+output/input byte ratio. Every run is appended to benchmark_history.jsonl
+and compared with the previous run of the same configuration on the
+same machine. Nothing is downloaded.
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import queue
+import datetime
+import tempfile
+import subprocess
+import multiprocessing
+
+import PIL
+from PIL import Image, ImageDraw, ImageFilter
+
+from check_image_memory import peak_rss_mb
+from image_processing import optimize_image_with_settings, archive_format_supported
+
+# Bump when the corpus changes so stale cached corpora are not reused
+CORPUS_VERSION = 1
+
+HISTORY_PATH = "benchmark_history.jsonl"
+
+# Seconds a configuration may run before it is reported as failed
+CONFIG_TIMEOUT = 3600
+
+# Slower by more than this fraction than the previous run is reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+# Pipeline configurations: name -> options for optimize_image_with_settings
+CONFIGS = {
+    'full-decode': {'draft': False},
+    'default': {},
+    'budget': {'max_bytes': 400 * 1024},
+    'progressive': {'progressive': True},
+    'transcode': {'transcode': True},
+    'webp': {'transcode': True, 'output_format': 'WEBP'},
+    'avif': {'transcode': True, 'output_format': 'AVIF'},
+}
+
+RESOLUTIONS = [(640, 480), (1920, 1080), (4032, 3024), (6000, 4000)]
+QUICK_RESOLUTIONS = [(640, 480), (1920, 1080)]
+
+
+def synthetic_photo(size, seed, alpha=False):
+    """A photo-like image: soft shapes over a gradient with sensor noise"""
+    rng = random.Random(seed)
+    width, height = size
+    img = Image.linear_gradient('L').resize(size).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(max(2, width // 40), max(3, width // 4))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=tuple(rng.randrange(256) for _ in range(3)))
+    img = img.filter(ImageFilter.GaussianBlur(max(1, width // 800)))
+    noise = Image.effect_noise(size, 12).convert('RGB')
+    img = Image.blend(img, noise, 0.08)
+    if alpha:
+        mask = Image.new('L', size, 0)
+        ImageDraw.Draw(mask).ellipse((width // 8, height // 8, width * 7 // 8, height * 7 // 8), fill=255)
+        img.putalpha(mask)
+    return img
+
+
+def synthetic_document(size):
+    """A scanned-document-like image: black text lines on white"""
+    img = Image.new('L', size, 255)
+    draw = ImageDraw.Draw(img)
+    line_height = max(12, size[1] // 60)
+    for y in range(line_height * 2, size[1] - line_height * 2, line_height * 2):
+        draw.text((line_height * 2, y), "Project 1042 - shipped - inspection photo log " * 4, fill=0)
+    return img
+
+
+def corpus_cases(resolutions):
+    """Yield (file_name, image, save_options) for every corpus image"""
+    for index, size in enumerate(resolutions):
+        label = f"{size[0]}x{size[1]}"
+        photo = synthetic_photo(size, index)
+        yield f"photo_{label}.jpg", photo, {'format': 'JPEG', 'quality': 92}
+
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 CW
+        yield f"rotated_{label}.jpg", photo, {'format': 'JPEG', 'quality': 92, 'exif': exif.tobytes()}
+
+        yield f"photo_{label}.png", photo, {'format': 'PNG'}
+        yield f"alpha_{label}.png", synthetic_photo(size, index, alpha=True), {'format': 'PNG'}
+        yield f"photo_{label}.tif", photo, {'format': 'TIFF', 'compression': 'tiff_lzw'}
+        yield f"alpha_{label}.tif", synthetic_photo(size, index, alpha=True), {'format': 'TIFF'}
+        yield f"scan_{label}.tif", synthetic_document(size).convert('1'), {'format': 'TIFF', 'compression': 'group4'}
+        yield f"photo_{label}.bmp", photo, {'format': 'BMP'}
+        yield f"photo_{label}.gif", photo.convert('P', palette=Image.ADAPTIVE), {'format': 'GIF'}
+
+
+def build_corpus(quick=False):
+    """Generate the corpus (once) and return the paths of its files"""
+    name = f"image_benchmark_corpus_v{CORPUS_VERSION}{'_quick' if quick else ''}"
+    corpus_dir = os.path.join(tempfile.gettempdir(), name)
+    done_marker = os.path.join(corpus_dir, '.complete')
+    if not os.path.exists(done_marker):
+        print(f"Generating corpus in {corpus_dir}...")
+        os.makedirs(corpus_dir, exist_ok=True)
+        for file_name, img, options in corpus_cases(QUICK_RESOLUTIONS if quick else RESOLUTIONS):
+            img.save(os.path.join(corpus_dir, file_name), **options)
+        open(done_marker, 'w').close()
+    return sorted(os.path.join(corpus_dir, file_name) for file_name in os.listdir(corpus_dir)
+                  if not file_name.startswith('.'))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_config(paths, options, repeat, results):
+    """Optimize every corpus file `repeat` times in this (fresh) process and report the metrics"""
+    baseline_mb = peak_rss_mb()
+    latencies = []
+    input_bytes = output_bytes = megapixels = failures = 0
+    for _ in range(repeat):
+        for path in paths:
+            with open(path, 'rb') as file:
+                image_data = file.read()
+            with Image.open(io.BytesIO(image_data)) as img:
+                megapixels += img.width * img.height / 1e6
+
+            start = time.perf_counter()
+            output, settings = optimize_image_with_settings(image_data, **options)
+            latencies.append(time.perf_counter() - start)
+
+            input_bytes += len(image_data)
+            output_bytes += len(output)
+            failures += settings is None
+
+    total = sum(latencies)
+    results.put({
+        'images': len(latencies),
+        'images_per_s': round(len(latencies) / total, 3),
+        'megapixels_per_s': round(megapixels / total, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'baseline_rss_mb': round(baseline_mb, 1),
+        'byte_ratio': round(output_bytes / input_bytes, 4),
+        'unoptimized': failures,
+    })
+
+
+def run_in_child(context, paths, options, repeat, timeout):
+    """Run one configuration in a fresh process; returns its metrics, or None if it crashed or timed out"""
+    results = context.Queue()
+    process = context.Process(target=run_config, args=(paths, options, repeat, results))
+    process.start()
+    deadline = time.time() + timeout
+    metrics = None
+    # Poll so a child that dies (e.g. a segfault in an encoder) is noticed instead of waiting forever
+    while metrics is None and time.time() < deadline:
+        try:
+            metrics = results.get(timeout=1)
+        except queue.Empty:
+            if process.exitcode is not None:
+                break
+    if metrics is None and process.is_alive():
+        process.terminate()
+    process.join()
+    return metrics
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_results(history_path, machine, corpus):
+    """Latest recorded metrics per configuration for this machine and corpus"""
+    previous = {}
+    if os.path.exists(history_path):
+        with open(history_path) as history:
+            for line in history:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('machine') == machine and record.get('corpus') == corpus:
+                    previous[record['config']] = record['metrics']
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help="small corpus for a fast smoke run")
+    parser.add_argument('--configs', default=','.join(CONFIGS), help="comma-separated configurations to run")
+    parser.add_argument('--repeat', type=int, default=1, help="passes over the corpus per configuration")
+    parser.add_argument('--timeout', type=int, default=CONFIG_TIMEOUT, help="seconds before a configuration is failed")
+    parser.add_argument('--history', default=HISTORY_PATH, help="JSONL file results are appended to")
+    parser.add_argument('--no-history', action='store_true', help="do not record this run")
+    args = parser.parse_args()
+
+    config_names = [name.strip() for name in args.configs.split(',') if name.strip()]
+    unknown = [name for name in config_names if name not in CONFIGS]
+    if unknown:
+        parser.error(f"unknown configuration(s): {', '.join(unknown)}; choose from {', '.join(CONFIGS)}")
+
+    paths = build_corpus(args.quick)
+    corpus_mb = sum(os.path.getsize(path) for path in paths) / 1024 / 1024
+    print(f"Corpus: {len(paths)} files, {corpus_mb:.1f} MB")
+
+    machine = f"{platform.node()} {platform.machine()} {os.cpu_count()} CPUs"
+    corpus = f"v{CORPUS_VERSION}{'-quick' if args.quick else ''}"
+    previous = previous_results(args.history, machine, corpus)
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    commit = git_commit()
+
+    context = multiprocessing.get_context('spawn')
+    print(f"{'config':>12} {'img/s':>7} {'MP/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'peak MB':>8} {'ratio':>7}  vs previous")
+    records = []
+    regressions = []
+    failures = []
+    for name in config_names:
+        options = CONFIGS[name]
+        output_format = options.get('output_format')
+        if output_format and not archive_format_supported(output_format):
+            print(f"{name:>12} skipped: this Pillow build cannot encode {output_format}")
+            continue
+
+        metrics = run_in_child(context, paths, options, args.repeat, args.timeout)
+        if metrics is None:
+            print(f"{name:>12} FAILED: the benchmark process crashed or timed out")
+            failures.append(name)
+            continue
+
+        comparison = ""
+        if name in previous:
+            change = previous[name]['images_per_s'] / metrics['images_per_s'] - 1
+            comparison = f"{change:+.0%} time"
+            if change > REGRESSION_THRESHOLD:
+                comparison += "  REGRESSION"
+                regressions.append(name)
+        print(
+            f"{name:>12} {metrics['images_per_s']:7.2f} {metrics['megapixels_per_s']:7.1f} {metrics['p50_ms']:8.1f} "
+            f"{metrics['p95_ms']:8.1f} {metrics['peak_rss_mb']:8.1f} {metrics['byte_ratio']:7.3f}  {comparison}"
+        )
+        records.append({
+            'timestamp': timestamp, 'commit': commit, 'machine': machine,
+            'python': platform.python_version(), 'pillow': PIL.__version__,
+            'corpus': corpus, 'repeat': args.repeat,
+            'config': name, 'options': options, 'metrics': metrics,
+        })
+
+    if records and not args.no_history:
+        with open(args.history, 'a') as history:
+            for record in records:
+                history.write(json.dumps(record) + "\n")
+        print(f"Results appended to {args.history}")
+    # A non-zero exit lets CI or a pre-merge script catch slowdowns and crashes
+    return 1 if regressions or failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
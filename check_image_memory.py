@@ -0,0 +1,64 @@
+"""
+Measure peak memory of optimize_image with and without the reduced-resolution decode.
+
+Usage: python check_image_memory.py [image.jpg]
+Without an argument a synthetic 48 MP JPEG is generated.
+"""
+import io
+import sys
+import time
+import resource
+import multiprocessing
+
+from PIL import Image
+
+from image_processing import optimize_image
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB.
+
+    VmHWM is read from /proc because ru_maxrss carries over the parent's
+    peak across fork and exec and would hide the difference.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(image_data, draft, results):
+    """Run one optimization in a fresh process and report its peak RSS"""
+    start = time.perf_counter()
+    output = optimize_image(image_data, draft=draft)
+    elapsed = time.perf_counter() - start
+    peak_mb = peak_rss_mb()
+    results.put((draft, peak_mb, elapsed, len(output)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as file:
+            image_data = file.read()
+    else:
+        print("Generating a synthetic 8000x6000 JPEG...")
+        buffer = io.BytesIO()
+        Image.effect_noise((8000, 6000), 40).convert('RGB').save(buffer, format='JPEG', quality=90)
+        image_data = buffer.getvalue()
+
+    print(f"Input: {len(image_data) / 1024 / 1024:.1f} MB")
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    for draft in (False, True):
+        process = context.Process(target=measure, args=(image_data, draft, results))
+        process.start()
+        draft, peak_mb, elapsed, output_size = results.get()
+        process.join()
+        label = "reduced decode" if draft else "full decode"
+        print(f"{label:>15}: peak RSS {peak_mb:7.1f} MB, {elapsed:5.2f} s, output {output_size / 1024:.0f} KB")
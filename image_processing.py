@@ -0,0 +1,524 @@
+"""
+Image processing for uploads.
+
+Kept free of Streamlit so the functions can run in worker processes.
+"""
+
+import io
+import os
+import threading
+import uuid
+
+import numpy as np
+from PIL import Image, ImageOps, ImageSequence, features
+
+
+class MemoryviewReader(io.RawIOBase):
+    """Read-only, seekable file object over a memoryview (or any bytes-like object) that never copies it whole.
+
+    io.BytesIO copies anything that is not `bytes`; this reader only
+    copies the ranges that are read.
+    """
+    
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+    
+    def tell(self):
+        return self._position
+    
+    def readinto(self, target):
+        chunk = self._view[self._position:self._position + len(target)]
+        target[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+def open_buffer(data):
+    """Open bytes or a memoryview as a seekable binary file without copying it"""
+    return io.BytesIO(data) if isinstance(data, bytes) else io.BufferedReader(MemoryviewReader(data))
+
+def _fit_size(size, max_size):
+    """Return the size that fits within max_size preserving aspect ratio, or None if no resize is needed"""
+    width, height = size
+    if max(width, height) <= max_size:
+        return None
+    if width > height:  # Width > Height
+        return max_size, max(1, int(height * (max_size / width)))
+    # Height > Width
+    return max(1, int(width * (max_size / height))), max_size
+
+# Formats converted to a compressed format when transcoding is requested
+TRANSCODE_FORMATS = ['TIFF', 'BMP']
+
+# File extension to use for each output format
+FORMAT_EXTENSIONS = {
+    'JPEG': ['.jpg', '.jpeg'], 'PNG': ['.png'], 'PDF': ['.pdf'], 'GIF': ['.gif'], 'BMP': ['.bmp'],
+    'TIFF': ['.tif', '.tiff'], 'WEBP': ['.webp'], 'AVIF': ['.avif']
+}
+
+# Archival output formats and encoder settings that look about the same as JPEG quality 85
+ARCHIVE_FORMATS = {
+    'WEBP': {'quality': 80, 'method': 4},
+    'AVIF': {'quality': 60, 'speed': 8},
+}
+
+def estimate_decode_bytes(input_path, max_size=1800, draft=True, **options):
+    """Estimate the peak memory optimizing the image at input_path takes, from its header alone.
+
+    Counts the file, the decoded pixels (JPEGs decode at the draft scale)
+    and one resized copy per page. Unreadable files count only their size.
+    `options` are the other optimize_image_with_settings arguments.
+    """
+    file_bytes = os.path.getsize(input_path)
+    try:
+        with Image.open(input_path) as img:
+            bands = len(img.getbands())
+            width, height = img.size
+            pages = getattr(img, 'n_frames', 1)
+            image_format = img.format
+    except Exception:
+        return file_bytes
+    
+    target_size = _fit_size((width, height), max_size) or (width, height)
+    scale = 1
+    if draft and image_format == 'JPEG':
+        # The decoder can scale by 1/2, 1/4 or 1/8 while staying at least the target size
+        while scale < 8 and width // (scale * 2) >= target_size[0] and height // (scale * 2) >= target_size[1]:
+            scale *= 2
+    decoded = (width // scale) * (height // scale) * bands
+    return file_bytes + decoded + pages * target_size[0] * target_size[1] * bands
+
+def load_image_plugins():
+    """Import every Pillow format plugin and codec check now rather than on first use (see get_image_process_pool)"""
+    Image.init()
+    for image_format in ARCHIVE_FORMATS:
+        features.check(image_format.lower())
+
+def archive_format_supported(image_format):
+    """True if this Pillow build can encode the given archival format"""
+    return image_format in ARCHIVE_FORMATS and features.check(image_format.lower())
+
+def output_file_name(file_name, settings):
+    """Rename a file to match the format it was optimized or transcoded to"""
+    stem, extension = os.path.splitext(file_name)
+    extensions = FORMAT_EXTENSIONS.get((settings or {}).get('format'))
+    if not extensions or extension.lower() in extensions:
+        return file_name
+    return f"{stem}{extensions[0]}"
+
+def _looks_like_document(img):
+    """True for bilevel, line-art or few-colour images, which compress better losslessly"""
+    if img.mode in ['1', 'P', 'LA', 'RGBA', 'PA'] or 'transparency' in img.info:
+        return True
+    sample = img.copy()
+    sample.thumbnail((256, 256))
+    return sample.convert('RGB').getcolors(maxcolors=64) is not None
+
+def _pages_to_pdf(img, max_size, quality):
+    """Save every page of a multi-page image as one compact PDF"""
+    pages = []
+    for frame in ImageSequence.Iterator(img):
+        page = frame.copy()
+        if page.mode not in ['1', 'L', 'RGB']:
+            # Palette and alpha pages would be stored uncompressed or fail
+            page = page.convert('L' if page.mode in ['I', 'I;16', 'LA'] else 'RGB')
+        target_size = _fit_size(page.size, max_size)
+        if target_size:
+            bilevel = page.mode == '1'
+            if bilevel:
+                page = page.convert('L')
+            page = page.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+            if bilevel:
+                # Threshold back to 1-bit so scans keep their compact encoding
+                page = page.convert('1', dither=Image.NONE)
+        pages.append(page)
+    
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format='PDF', save_all=True, append_images=pages[1:], quality=quality)
+    return buffer.getvalue()
+
+# PIL subsampling values by name
+SUBSAMPLING = {'4:4:4': 0, '4:2:2': 1, '4:2:0': 2}
+
+def _encode_jpeg(img, quality, subsampling, progressive=False, exif=None, optimize=True):
+    buffer = io.BytesIO()
+    img.save(
+        buffer, format='JPEG', quality=quality, subsampling=SUBSAMPLING[subsampling],
+        optimize=optimize, progressive=progressive, **({'exif': exif} if exif else {})
+    )
+    return buffer.getvalue()
+
+def _search_jpeg_quality(img, max_bytes, min_quality, max_quality):
+    """Binary-search the highest 4:2:0 quality whose fast baseline encode fits max_bytes, or None"""
+    best = None
+    low, high = min_quality, max_quality
+    quality = max_quality  # Most images fit at full quality, so try that first
+    while low <= high:
+        size = len(_encode_jpeg(img, quality, '4:2:0', optimize=False))
+        if size <= max_bytes:
+            best = quality
+            # Close enough to the budget that a higher quality gains little
+            if quality == max_quality or size >= max_bytes * 0.95:
+                break
+            low = quality + 1
+        else:
+            high = quality - 1
+        quality = (low + high) // 2
+    return best
+
+def encode_jpeg_to_budget(img, max_bytes, min_quality=40, max_quality=92, progressive=False, exif=None,
+                         full_chroma=False):
+    """Encode a JPEG at the highest quality that fits in max_bytes.
+
+    Quality is binary-searched with fast baseline 4:2:0 encodes, stopping
+    early within 5% of the budget; the final image is then encoded once
+    with optimized Huffman tables (and progressive scans if requested),
+    which only makes it smaller. The EXIF block counts against the budget.
+    With `full_chroma`, full-resolution chroma (4:4:4) is used if
+    max_quality fits and it still fits; it is typically 30-40% larger. If
+    even min_quality is too large, the image is scaled down by 20% and
+    searched again, up to three times. Returns (data, settings).
+    """
+    if img.mode not in ['RGB', 'L', 'CMYK']:
+        img = img.convert('RGB')
+    
+    # The search encodes without EXIF, which the final encode adds in an APP1 segment (marker and length: 4 bytes)
+    image_budget = max_bytes - (len(exif) + 4 if exif else 0)
+    for attempt in range(4):
+        quality = _search_jpeg_quality(img, image_budget, min_quality, max_quality)
+        if quality is not None or attempt == 3:
+            break
+        img = img.resize((max(1, int(img.width * 0.8)), max(1, int(img.height * 0.8))), Image.LANCZOS)
+    
+    quality = quality or min_quality
+    subsampling = '4:2:0'
+    data = _encode_jpeg(img, quality, subsampling, progressive, exif)
+    if full_chroma and quality == max_quality:
+        full_chroma_data = _encode_jpeg(img, quality, '4:4:4', progressive, exif)
+        if len(full_chroma_data) <= max_bytes:
+            data, subsampling = full_chroma_data, '4:4:4'
+    
+    return data, {
+        'format': 'JPEG', 'quality': quality, 'subsampling': subsampling,
+        'progressive': progressive, 'size': img.size, 'bytes': len(data)
+    }
+
+def optimize_image_with_settings(image_data, max_size=1800, quality=85, draft=True, max_bytes=None, progressive=False,
+                                 transcode=False, output_format=None):
+    """Optimize image by resizing and compressing. Returns (data, settings)
+
+    With `draft`, JPEGs are decoded directly at the smallest 1/2, 1/4 or
+    1/8 scale that is still at least the target size, and other formats
+    are box-reduced before the final LANCZOS pass, so a 48 MP photo never
+    has to be held in memory at full resolution.
+
+    With `max_bytes`, JPEGs are encoded at the highest quality up to
+    `quality` that fits the budget (see encode_jpeg_to_budget), with the
+    same 4:2:0 chroma as the fixed-quality path, so a generous budget
+    never makes images larger than a fixed quality would.
+
+    With `transcode`, TIFF and BMP images are converted: multi-page files
+    to one PDF, documents and line art to PNG, and photos to JPEG. Use
+    output_file_name to give the result a matching extension.
+
+    With `output_format` ('WEBP' or 'AVIF'), still images are re-encoded
+    in that format at a quality matched to JPEG 85, if Pillow supports it.
+
+    A transcoded result that is not smaller than the original is discarded.
+    `settings` describes what was chosen; it is None if the original bytes
+    were returned.
+    """
+    try:
+        # Open image from bytes
+        img = Image.open(io.BytesIO(image_data))
+        # Resized images lose their format, so remember it for saving
+        source_format = img.format
+        image_format = source_format
+        exif = img.info.get('exif')
+        
+        if transcode and image_format in TRANSCODE_FORMATS:
+            if getattr(img, 'n_frames', 1) > 1:
+                data = _pages_to_pdf(img, max_size, quality)
+                if len(data) >= len(image_data):
+                    return image_data, None
+                return data, {'format': 'PDF', 'pages': img.n_frames, 'bytes': len(data)}
+            
+            if _looks_like_document(img):
+                image_format = 'PNG'
+                if img.mode not in ['1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16']:
+                    img = img.convert('RGB')
+            else:
+                image_format = 'JPEG'
+                if img.mode not in ['RGB', 'L']:
+                    img = img.convert('RGB')
+            exif = None
+        
+        if output_format and archive_format_supported(output_format) and getattr(img, 'n_frames', 1) == 1:
+            image_format = output_format
+            if img.mode not in ['RGB', 'RGBA']:
+                has_alpha = img.mode in ['LA', 'RGBA', 'PA'] or 'transparency' in img.info
+                img = img.convert('RGBA' if has_alpha else 'RGB')
+        
+        # Check if resize is needed
+        target_size = _fit_size(img.size, max_size)
+        if target_size:
+            bilevel = img.mode == '1'
+            if bilevel:
+                # Bilevel images only support nearest-neighbour resizing
+                img = img.convert('L')
+            if draft and source_format == 'JPEG':
+                # Scale in the decoder instead of decoding every pixel
+                img.draft(img.mode, target_size)
+            
+            # Resize with high quality
+            img = img.resize(target_size, Image.LANCZOS, reducing_gap=3.0 if draft else None)
+            if bilevel:
+                # Threshold back to 1-bit: greyscale scans are several times larger
+                img = img.convert('1', dither=Image.NONE)
+        
+        # Save to buffer with optimization
+        buffer = io.BytesIO()
+        settings = {'format': image_format, 'size': img.size}
+        
+        # Save with format-specific optimizations
+        if image_format == 'JPEG' and max_bytes:
+            data, settings = encode_jpeg_to_budget(img, max_bytes, max_quality=quality, progressive=progressive, exif=exif)
+            buffer.write(data)
+        elif image_format == 'JPEG':
+            # Keep EXIF so the camera orientation survives
+            img.save(
+                buffer, format=image_format, quality=quality, optimize=True, progressive=progressive,
+                **({'exif': exif} if exif else {})
+            )
+            settings.update(quality=quality, progressive=progressive)
+        elif image_format in ARCHIVE_FORMATS:
+            img.save(buffer, format=image_format, **ARCHIVE_FORMATS[image_format], **({'exif': exif} if exif else {}))
+            settings.update(ARCHIVE_FORMATS[image_format])
+        elif image_format == 'PNG':
+            img.save(buffer, format=image_format, optimize=True)
+        elif image_format == 'TIFF':
+            # Never inherit the source's compression: Group 4 is only valid for bilevel images
+            compression = 'group4' if img.mode == '1' else 'tiff_lzw'
+            img.save(buffer, format=image_format, compression=compression)
+            settings['compression'] = compression
+        else:
+            # For other formats, just save with default settings
+            img.save(buffer, format=image_format)
+            
+        if image_format != source_format and buffer.tell() >= len(image_data):
+            # Transcoding only pays off if it shrinks the file
+            return image_data, None
+        settings['bytes'] = buffer.tell()
+        return buffer.getvalue(), settings
+    except Exception as e:
+        # If optimization fails, return original data
+        return image_data, None
+
+def optimize_image(image_data, max_size=1800, quality=85, draft=True, max_bytes=None, progressive=False):
+    """Optimize image by resizing and compressing"""
+    return optimize_image_with_settings(image_data, max_size, quality, draft, max_bytes, progressive)[0]
+
+def optimize_image_file(input_path, output_path, **options):
+    """Optimize the image at input_path and write the result to output_path.
+
+    Runs in a worker process; only file paths cross the process boundary,
+    so large buffers are never pickled. The output is written atomically.
+    `options` are passed to optimize_image_with_settings; the chosen
+    settings are returned.
+    """
+    with open(input_path, 'rb') as file:
+        image_data = file.read()
+    
+    optimized_data, settings = optimize_image_with_settings(image_data, **options)
+    
+    temp_path = f"{output_path}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(optimized_data)
+    os.replace(temp_path, output_path)
+    return settings
+
+def make_thumbnail(image_data, max_size=256, quality=80):
+    """Return a small JPEG (or PNG, for images with transparency) that fits within max_size.
+
+    JPEGs are decoded at reduced resolution, so this stays cheap for large
+    photos. The EXIF orientation is applied. Returns None if the data
+    cannot be read as an image.
+    """
+    try:
+        img = Image.open(open_buffer(image_data))
+        img.draft('RGB', (max_size, max_size))
+        # Phone photos are stored sideways with an EXIF orientation tag; thumbnails carry no EXIF
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_size, max_size), Image.LANCZOS, reducing_gap=3.0)
+        buffer = io.BytesIO()
+        if img.mode in ['LA', 'RGBA', 'PA'] or 'transparency' in img.info:
+            img.convert('RGBA').save(buffer, format='PNG', optimize=True)
+        else:
+            img.convert('RGB').save(buffer, format='JPEG', quality=quality, optimize=True)
+        return buffer.getvalue()
+    except Exception:
+        return None
+
+class DiskLRUCache:
+    """Byte-bounded cache of blobs stored as files under one directory.
+
+    Keys must be safe file names (e.g. content hashes). Writes are atomic,
+    so concurrent readers and worker processes never see partial files.
+    Each hit refreshes the file's modification time; once the total size
+    passes max_bytes the least recently used files are removed.
+    """
+    
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(entry.stat().st_size for entry in self._entries())
+    
+    def _entries(self):
+        return [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith('.tmp')]
+    
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+    
+    def get(self, key):
+        """Return the cached bytes for key, or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+    
+    def put(self, key, data):
+        path = self._path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.replace(temp_path, path)
+        
+        with self._lock:
+            self._total_bytes += len(data) - replaced
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+    
+    def get_or_create(self, key, create):
+        """Return the cached bytes for key, calling create() and caching its result on a miss"""
+        data = self.get(key)
+        if data is None:
+            data = create()
+            if data is not None:
+                self.put(key, data)
+        return data
+    
+    def _evict(self):
+        """Remove least recently used files until the cache is back to 90% of max_bytes"""
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        self._total_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._total_bytes -= size
+            except OSError:
+                pass
+
+def difference_hash(image_data, hash_size=8):
+    """64-bit dHash of an image: whether each pixel of a small grayscale copy is brighter than its right neighbour.
+
+    Near-identical photos (re-shot, re-encoded or slightly re-framed) have
+    hashes within a few bits of each other. Returns None if the data
+    cannot be read as an image.
+    """
+    try:
+        img = Image.open(open_buffer(image_data))
+        img.draft('L', (hash_size * 8, hash_size * 8))
+        pixels = np.asarray(img.convert('L').resize((hash_size + 1, hash_size), Image.BOX), dtype=np.int16)
+    except Exception:
+        return None
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming_distance(hash_a, hash_b):
+    return (hash_a ^ hash_b).bit_count()
+
+class BKTree:
+    """Burkhard-Keller tree of integer hashes for Hamming-distance range queries.
+
+    Each child edge is labelled with its distance to the parent, so a
+    search only descends into children whose label is within max_distance
+    of the query's distance to the parent (triangle inequality); lookups
+    touch a small fraction of the tree as it grows.
+    """
+    
+    def __init__(self):
+        self._root = None
+        self.size = 0
+    
+    def add(self, item_hash, value):
+        self.size += 1
+        if self._root is None:
+            self._root = (item_hash, [value], {})
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(item_hash, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            if distance not in node[2]:
+                node[2][distance] = (item_hash, [value], {})
+                return
+            node = node[2][distance]
+    
+    def search(self, item_hash, max_distance):
+        """Return (distance, value) pairs for hashes within max_distance, closest first"""
+        matches = []
+        nodes = [self._root] if self._root else []
+        while nodes:
+            node_hash, values, children = nodes.pop()
+            distance = hamming_distance(item_hash, node_hash)
+            if distance <= max_distance:
+                matches.extend((distance, value) for value in values)
+            nodes.extend(child for edge, child in children.items() if abs(edge - distance) <= max_distance)
+        return sorted(matches, key=lambda match: match[0])
+
+def find_near_duplicates(hashes, max_distance, history=None):
+    """Flag hashes that are near-duplicates of an earlier one in the batch or in `history`.
+
+    `hashes` is a list with None for files that are not images; `history`
+    is a BKTree of earlier uploads. Returns {index: (distance, match)}
+    where match is the earlier index in the batch or a history value.
+    """
+    batch = BKTree()
+    duplicates = {}
+    for index, item_hash in enumerate(hashes):
+        if item_hash is None:
+            continue
+        matches = batch.search(item_hash, max_distance)
+        if not matches and history is not None:
+            matches = history.search(item_hash, max_distance)
+        if matches:
+            duplicates[index] = matches[0]
+        else:
+            batch.add(item_hash, index)
+    return duplicates
@@ -3,9 +3,9 @@ import sys
 import streamlit as st
 import pandas as pd
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
+import base64
+import email.utils
+from email.header import Header
 
 # Configure page to collapse sidebar by default
 st.set_page_config(
@@ -22,10 +22,26 @@ import shutil
 import uuid
 import tempfile
 import subprocess
-from PIL import Image
 import pyodbc
 import urllib.parse
 import msal
+import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
+import threading
+import sqlite3
+import random
+import hashlib
+import queue
+import mmap
+import contextlib
+import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from image_processing import (
+    optimize_image_file, output_file_name, make_thumbnail, DiskLRUCache, difference_hash, find_near_duplicates, BKTree,
+    open_buffer, load_image_plugins, estimate_decode_bytes
+)
 
 # Set page configuration
 st.set_page_config(
@@ -34,24 +50,54 @@ st.set_page_config(
     layout="centered"
 )
 
-# Display logo at the left
-col1, col2, col3 = st.columns([1, 2, 1])
-with col1:
-    # Load image with PIL and resize with high quality
-    img = Image.open("logo.jpg")
-    # Resize with high quality resampling
-    new_width = 150
-    width_percent = (new_width / float(img.size[0]))
-    new_height = int((float(img.size[1]) * float(width_percent)))
-    img = img.resize((new_width, new_height), Image.LANCZOS)
-    # Display the resized image
-    st.image(img)
-
 # File paths
 UPLOAD_FOLDER = "uploads"
+STATE_FOLDER = ".app_state"  # Local indexes and caches that survive restarts
+SHAREPOINT_INDEX_DB = os.path.join(STATE_FOLDER, "sharepoint_index.sqlite")
+UPLOAD_INDEX_MAX_ENTRIES = 50000  # Least recently used uploads are forgotten beyond this
+MIRROR_SYNC_INTERVAL = 300  # Seconds before the local library mirror is considered stale
+THUMBNAIL_FOLDER = os.path.join(STATE_FOLDER, "thumbnails")
+THUMBNAIL_CACHE_MAX_BYTES = 200 * 1024 * 1024  # Least recently used thumbnails are removed beyond this
+THUMBNAIL_SIZE = 256  # Longest side of preview thumbnails in pixels
+PHOTO_HASH_DB = os.path.join(STATE_FOLDER, "photo_hashes.sqlite")
+NEAR_DUPLICATE_MAX_DISTANCE = 6  # Photos whose 64-bit perceptual hashes differ in at most this many bits are near-duplicates
+NEAR_DUPLICATE_HISTORY_DAYS = 90  # Earlier uploads to the same project or order compared against
+OUTBOX_DB = os.path.join(STATE_FOLDER, "outbox.sqlite")
+OUTBOX_FOLDER = os.path.join(UPLOAD_FOLDER, "outbox")  # Files of queued email and SharePoint jobs, one folder per job
+OUTBOX_WORKERS = 2  # Background threads delivering queued jobs
+OUTBOX_MAX_ATTEMPTS = 6  # Deliveries tried before a job is marked failed
+OUTBOX_RETRY_DELAY = 30  # Seconds before the first retry; doubles per attempt, up to 30 minutes
+OUTBOX_RETENTION_DAYS = 7  # Finished jobs are forgotten (and their files removed) after this
+OUTBOX_STATUS_REFRESH = 3  # Seconds between job status updates in the UI
+SLACK_BATCH_WINDOW = 2  # Seconds; notifications arriving this close together are posted as one message
+SLACK_MIN_INTERVAL = 1  # Seconds between webhook posts (Slack allows about one per second)
+SLACK_TIMEOUT = (5, 10)  # (connect, read) seconds for webhook posts
+LOGO_PATH = "logo.jpg"
+LOGO_WIDTH = 150
 
 # Allowed file extensions for uploads
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tif', 'tiff', 'pdf'}
+OPTIMIZABLE_IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff']
+
+# Email size limits
+EMAIL_MAX_MESSAGE_BYTES = 20 * 1024 * 1024  # Mail relay limit for one message, after base64 encoding
+EMAIL_PROGRESSIVE_JPEG = True  # Send progressive JPEGs (usually a little smaller)
+EMAIL_MAX_ATTACHMENTS = 20  # Attachments per message; larger batches are split across several emails
+EMAIL_DIGEST_WINDOW = 0  # Seconds to hold a Procore submission so later ones for the same project and status join it (0 disables)
+EMAIL_DIGEST_MAX_FILES = 20  # A held submission is sent at once when it reaches this many files...
+EMAIL_DIGEST_MAX_BYTES = 50 * 1024 * 1024  # ...or this many bytes of uploaded files
+EMAIL_SPOOL_MAX_BYTES = 1024 * 1024  # Messages are written to a spooled file that moves to disk beyond this size
+EMAIL_ENCODE_CHUNK_SIZE = 57 * 4096  # Attachment bytes base64-encoded at a time (a multiple of 57 gives whole 76-character lines)
+SMTP_POOL_SIZE = 4  # Authenticated SMTP connections kept open and used at once across all sessions
+SMTP_IDLE_TIMEOUT = 240  # Seconds; idle connections are closed before the relay drops them
+SMTP_TIMEOUT = 60  # Seconds for SMTP socket operations
+
+# Image processing
+IMAGE_PROCESS_WORKERS = min(4, os.cpu_count() or 1)  # Worker processes for image optimization (0 disables)
+OPTIMIZED_IMAGE_FOLDER = os.path.join(STATE_FOLDER, "optimized")
+OPTIMIZED_IMAGE_CACHE_MAX_BYTES = 500 * 1024 * 1024  # Least recently used optimized images are removed beyond this
+UPLOAD_MEMORY_BUDGET_BYTES = 256 * 1024 * 1024  # Decoded images and upload buffers held in memory at once across all sessions; extra work waits
+OPTIMIZED_IMAGE_CACHE_VERSION = 1  # Bump when optimize_image output changes so stale entries are not reused
 
 # Initialize with empty defaults
 EMAIL_SENDER = ""
@@ -80,6 +126,21 @@ SHAREPOINT_CLIENT_SECRET = ""
 SHAREPOINT_TENANT_ID = ""
 SHAREPOINT_AUTHORITY = ""
 SHAREPOINT_SCOPES = ["https://graph.microsoft.com/.default"]
+SHAREPOINT_DRIVE_NAME = "Shopify_orders_photos"
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+GRAPH_TIMEOUT = (10, 60)  # (connect, read) seconds for Graph requests
+GRAPH_BATCH_LIMIT = 20  # Maximum requests per Graph $batch call
+GRAPH_MAX_CONCURRENCY = 16  # Upper bound for in-flight Graph requests across all sessions
+GRAPH_MAX_RETRIES = 5  # Retries for throttled (429/503) or failed Graph requests
+GRAPH_BACKOFF_BASE = 1  # Seconds; backoff doubles per retry, with full jitter
+GRAPH_BACKOFF_CAP = 60
+SHOPIFY_FOLDER_STATUSES = ["PRODUCTION", "SHIPPED", "PICKUP", "INSTALLATION"]
+SHAREPOINT_UPLOAD_CONCURRENCY = 4  # Number of files uploaded to SharePoint in parallel
+SHAREPOINT_SIMPLE_UPLOAD_LIMIT = 4 * 1024 * 1024  # Larger files use a resumable upload session
+SHAREPOINT_UPLOAD_CHUNK_SIZE = 10 * 320 * 1024  # Upload session chunk size (must be a multiple of 320 KiB)
+SHAREPOINT_UPLOAD_MAX_RETRIES = 5  # Attempts to resume a chunk before giving up
+SHAREPOINT_IMAGE_FORMAT = "original"  # Format images are stored in: "original", "webp" or "avif"
+SHAREPOINT_KEEP_ORIGINAL = False  # Also keep the untouched files in an Originals subfolder
 
 # Override with secrets if available
 try:
@@ -92,6 +153,14 @@ try:
         BREVO_SMTP_PASSWORD = st.secrets.get("BREVO_SMTP_PASSWORD", BREVO_SMTP_PASSWORD)
         ADMIN_PASSWORD = st.secrets.get("ADMIN_PASSWORD", ADMIN_PASSWORD)
         SLACK_WEBHOOK_URL = st.secrets.get("SLACK_WEBHOOK_URL", SLACK_WEBHOOK_URL)
+        IMAGE_PROCESS_WORKERS = int(st.secrets.get("IMAGE_PROCESS_WORKERS", IMAGE_PROCESS_WORKERS))
+        UPLOAD_MEMORY_BUDGET_BYTES = int(st.secrets.get("UPLOAD_MEMORY_BUDGET_BYTES", UPLOAD_MEMORY_BUDGET_BYTES))
+        OPTIMIZED_IMAGE_CACHE_MAX_BYTES = int(st.secrets.get("OPTIMIZED_IMAGE_CACHE_MAX_BYTES", OPTIMIZED_IMAGE_CACHE_MAX_BYTES))
+        EMAIL_MAX_MESSAGE_BYTES = int(st.secrets.get("EMAIL_MAX_MESSAGE_BYTES", EMAIL_MAX_MESSAGE_BYTES))
+        EMAIL_PROGRESSIVE_JPEG = bool(st.secrets.get("EMAIL_PROGRESSIVE_JPEG", EMAIL_PROGRESSIVE_JPEG))
+        EMAIL_MAX_ATTACHMENTS = int(st.secrets.get("EMAIL_MAX_ATTACHMENTS", EMAIL_MAX_ATTACHMENTS))
+        EMAIL_DIGEST_WINDOW = int(st.secrets.get("EMAIL_DIGEST_WINDOW", EMAIL_DIGEST_WINDOW))
+        SMTP_POOL_SIZE = int(st.secrets.get("SMTP_POOL_SIZE", SMTP_POOL_SIZE))
         
     # Load database credentials from secrets if available
     if 'DB_SERVER' in st.secrets:
@@ -107,6 +176,9 @@ try:
         SHAREPOINT_CLIENT_SECRET = st.secrets.get("SHAREPOINT_CLIENT_SECRET", SHAREPOINT_CLIENT_SECRET)
         SHAREPOINT_TENANT_ID = st.secrets.get("SHAREPOINT_TENANT_ID", SHAREPOINT_TENANT_ID)
         SHAREPOINT_AUTHORITY = f"https://login.microsoftonline.com/{SHAREPOINT_TENANT_ID}"
+        SHAREPOINT_UPLOAD_CONCURRENCY = int(st.secrets.get("SHAREPOINT_UPLOAD_CONCURRENCY", SHAREPOINT_UPLOAD_CONCURRENCY))
+        SHAREPOINT_IMAGE_FORMAT = st.secrets.get("SHAREPOINT_IMAGE_FORMAT", SHAREPOINT_IMAGE_FORMAT).lower()
+        SHAREPOINT_KEEP_ORIGINAL = bool(st.secrets.get("SHAREPOINT_KEEP_ORIGINAL", SHAREPOINT_KEEP_ORIGINAL))
         
         # Use appropriate driver format based on platform
         if os.name == 'nt':  # Windows
@@ -119,79 +191,875 @@ except Exception as e:
 # Create upload folder if it doesn't exist
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
+os.makedirs(STATE_FOLDER, exist_ok=True)
     
 # Helper functions
 def verify_password(password):
     """Verify if the provided password matches the admin password"""
     return password == ADMIN_PASSWORD
 
+# Shared Microsoft Graph client
+class AdaptiveLimiter:
+    """Limits in-flight requests and adapts the limit AIMD-style.
+
+    Every successful request raises the limit by 1/limit (about +1 per
+    round of requests); a throttling response halves it, at most once per
+    second so a burst of 429s from one wave counts as one signal.
+    """
+    
+    def __init__(self, initial, maximum, minimum=1):
+        self._condition = threading.Condition()
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.in_flight = 0
+        self._last_decrease = 0
+    
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+    
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.on_throttle()
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+    
+    def on_throttle(self):
+        with self._condition:
+            now = time.time()
+            if now - self._last_decrease >= 1:
+                self.limit = max(self.minimum, self.limit / 2)
+                self._last_decrease = now
+
+def _retry_delay(retry_after, attempt):
+    """Seconds to wait before retrying: Retry-After if given, else jittered exponential backoff"""
+    if retry_after:
+        try:
+            return min(float(retry_after), GRAPH_BACKOFF_CAP)
+        except ValueError:
+            pass
+    return random.uniform(0, min(GRAPH_BACKOFF_CAP, GRAPH_BACKOFF_BASE * 2 ** attempt))
+
+class GraphClient:
+    """Microsoft Graph client with pooled keep-alive connections and a cached drive ID"""
+    
+    def __init__(self, pool_size=GRAPH_MAX_CONCURRENCY, timeout=GRAPH_TIMEOUT):
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Keep a connection for every request the limiter lets through; a smaller pool
+        # opens extra connections under load and then discards them
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(pool_size, GRAPH_MAX_CONCURRENCY))
+        self.session.mount("https://", adapter)
+        self.limiter = AdaptiveLimiter(initial=max(1, GRAPH_MAX_CONCURRENCY // 2), maximum=GRAPH_MAX_CONCURRENCY)
+        self._drive_ids = {}
+        self._lock = threading.Lock()
+    
+    def request(self, method, url, token=None, **kwargs):
+        """Send a request, adding the bearer token and the default timeout.
+
+        Throttled (429/503) and gateway-timeout (504) responses and connection
+        errors are retried, honoring Retry-After, up to GRAPH_MAX_RETRIES times.
+        """
+        if url.startswith('/'):
+            url = f'{GRAPH_BASE_URL}{url}'
+        headers = dict(kwargs.pop('headers', None) or {})
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        kwargs.setdefault('timeout', self.timeout)
+        
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            self.limiter.acquire()
+            response = None
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == GRAPH_MAX_RETRIES:
+                    raise
+            finally:
+                # Release the slot on every path, including unexpected errors (e.g. ChunkedEncodingError)
+                self.limiter.release(response is not None and response.status_code in [429, 503])
+            
+            if response is None:
+                time.sleep(_retry_delay(None, attempt))
+                continue
+            if response.status_code in [429, 503, 504] and attempt < GRAPH_MAX_RETRIES:
+                time.sleep(_retry_delay(response.headers.get('Retry-After'), attempt))
+                continue
+            return response
+    
+    def get(self, url, token=None, **kwargs):
+        return self.request('GET', url, token, **kwargs)
+    
+    def post(self, url, token=None, **kwargs):
+        return self.request('POST', url, token, **kwargs)
+    
+    def put(self, url, token=None, **kwargs):
+        return self.request('PUT', url, token, **kwargs)
+    
+    def get_drive_id(self, token, drive_name):
+        """Resolve a document library name to its drive ID, once per process"""
+        with self._lock:
+            if drive_name in self._drive_ids:
+                return self._drive_ids[drive_name], None
+            
+            url = '/sites/root/drives'
+            while url:
+                response = self.get(url, token)
+                if response.status_code != 200:
+                    return None, f"Failed to get drives: {response.status_code} - {response.text}"
+                
+                drives_data = response.json()
+                for drive in drives_data.get('value', []):
+                    if drive.get('name') == drive_name:
+                        self._drive_ids[drive_name] = drive.get('id')
+                        return drive.get('id'), None
+                url = drives_data.get('@odata.nextLink')
+            
+            return None, f"{drive_name} library not found"
+
+@st.cache_resource
+def get_graph_client():
+    """Create the process-wide Graph client"""
+    return GraphClient(pool_size=max(GRAPH_MAX_CONCURRENCY, SHAREPOINT_UPLOAD_CONCURRENCY * 2))
+
+# Local SharePoint folder index
+def split_folder_path(folder_path):
+    """Split a folder path into its non-empty segments"""
+    return [segment.strip() for segment in folder_path.strip('/').split('/') if segment.strip()]
+
+def _folder_index_key(segments):
+    """Normalized index key for a list of path segments (SharePoint names are case-insensitive)"""
+    return '/'.join(segment.casefold() for segment in segments)
+
+class FolderIndex:
+    """Maps normalized SharePoint folder paths to driveItem IDs.
+
+    Every prefix of a resolved path is stored as its own row, so the table
+    works as a path trie: resolving a folder is one lookup for the deepest
+    known ancestor, followed by Graph calls only for the missing segments.
+    """
+    
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS folder_index (
+            drive_id TEXT NOT NULL,
+            path TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (drive_id, path)
+        )
+        """)
+        self._conn.commit()
+    
+    def deepest_ancestor(self, drive_id, segments):
+        """Return (depth, item_id) of the deepest indexed prefix of `segments`"""
+        keys = [_folder_index_key(segments[:depth]) for depth in range(1, len(segments) + 1)]
+        if not keys:
+            return 0, "root"
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT path, item_id FROM folder_index WHERE drive_id = ? AND path IN ({','.join('?' * len(keys))})",
+                [drive_id] + keys
+            ).fetchall()
+        found = dict(rows)
+        for depth in range(len(keys), 0, -1):
+            if keys[depth - 1] in found:
+                return depth, found[keys[depth - 1]]
+        return 0, "root"
+    
+    def store(self, drive_id, segments, item_id):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO folder_index (drive_id, path, item_id, updated_at) VALUES (?, ?, ?, ?)",
+                (drive_id, _folder_index_key(segments), item_id, time.time())
+            )
+            self._conn.commit()
+    
+    def invalidate(self, drive_id, segments):
+        """Forget a folder and everything indexed below it"""
+        key = _folder_index_key(segments)
+        escaped = key.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM folder_index WHERE drive_id = ? AND (path = ? OR path LIKE ? ESCAPE '\\')",
+                (drive_id, key, f"{escaped}/%")
+            )
+            self._conn.commit()
+
+@st.cache_resource
+def get_folder_index():
+    """Open the process-wide folder index"""
+    return FolderIndex(SHAREPOINT_INDEX_DB)
+
+class UploadIndex:
+    """Persistent SHA-256 index of files already uploaded to SharePoint folders.
+
+    Keyed by (content hash, drive, folder), so the same photo uploaded to
+    the same order again is skipped without touching Graph. Bounded to
+    `max_entries` rows, evicting the least recently used.
+    """
+    
+    def __init__(self, db_path, max_entries=UPLOAD_INDEX_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS uploaded_files (
+            content_hash TEXT NOT NULL,
+            drive_id TEXT NOT NULL,
+            folder_id TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            item_id TEXT,
+            web_url TEXT,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (content_hash, drive_id, folder_id)
+        )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS uploaded_files_last_used ON uploaded_files (last_used)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS upload_index_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.commit()
+    
+    def lookup(self, content_hash, drive_id, folder_id):
+        """Return the web URL of an earlier upload of this content to this folder, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT web_url FROM uploaded_files WHERE content_hash = ? AND drive_id = ? AND folder_id = ?",
+                (content_hash, drive_id, folder_id)
+            ).fetchone()
+            if row:
+                self._conn.execute(
+                    "UPDATE uploaded_files SET last_used = ? WHERE content_hash = ? AND drive_id = ? AND folder_id = ?",
+                    (time.time(), content_hash, drive_id, folder_id)
+                )
+            self._count('hits' if row else 'misses')
+            self._conn.commit()
+        return row[0] if row else None
+    
+    def record(self, content_hash, drive_id, folder_id, file_name, item_id, web_url, size):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploaded_files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (content_hash, drive_id, folder_id, file_name, item_id, web_url, size, time.time())
+            )
+            self._conn.execute(
+                """DELETE FROM uploaded_files WHERE last_used <= (
+                    SELECT last_used FROM uploaded_files ORDER BY last_used DESC LIMIT 1 OFFSET ?
+                )""",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+    
+    def forget_items(self, item_ids):
+        """Drop entries whose SharePoint items were deleted"""
+        with self._lock:
+            self._conn.executemany("DELETE FROM uploaded_files WHERE item_id = ?", [(item_id,) for item_id in item_ids])
+            self._conn.commit()
+    
+    def _count(self, name):
+        self._conn.execute(
+            "INSERT INTO upload_index_stats (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,)
+        )
+    
+    def stats(self):
+        """Return {'hits', 'misses', 'entries'}"""
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT name, value FROM upload_index_stats").fetchall())
+            entries = self._conn.execute("SELECT COUNT(*) FROM uploaded_files").fetchone()[0]
+        return {'hits': counts.get('hits', 0), 'misses': counts.get('misses', 0), 'entries': entries}
+
+@st.cache_resource
+def get_upload_index():
+    """Open the process-wide upload deduplication index"""
+    return UploadIndex(SHAREPOINT_INDEX_DB)
+
+class DriveMirror:
+    """Local SQLite mirror of a SharePoint library, kept current with Graph delta queries.
+
+    The first sync walks the whole library; later syncs resume from the
+    stored delta link and only download what changed. Paths are stored
+    case-folded next to the display names so folder lookups and reports
+    are served locally.
+    """
+    
+    DELTA_SELECT = 'id,name,parentReference,folder,file,size,lastModifiedDateTime,deleted,root'
+    
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS mirror_items (
+            drive_id TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            parent_id TEXT,
+            name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            path_key TEXT NOT NULL,
+            is_folder INTEGER NOT NULL,
+            size INTEGER,
+            quick_xor_hash TEXT,
+            last_modified TEXT,
+            PRIMARY KEY (drive_id, item_id)
+        )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS mirror_items_path ON mirror_items (drive_id, path_key)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS mirror_items_parent ON mirror_items (drive_id, parent_id)")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS mirror_state (
+            drive_id TEXT PRIMARY KEY,
+            delta_link TEXT,
+            synced_at REAL
+        )
+        """)
+        self._conn.commit()
+    
+    def last_synced(self, drive_id):
+        with self._lock:
+            row = self._conn.execute("SELECT synced_at FROM mirror_state WHERE drive_id = ?", (drive_id,)).fetchone()
+        return row[0] if row and row[0] else 0
+    
+    def sync(self, token, drive_id):
+        """Apply all changes since the last sync. Returns (changed_count, deleted_item_ids, error)"""
+        with self._sync_lock:
+            with self._lock:
+                row = self._conn.execute("SELECT delta_link FROM mirror_state WHERE drive_id = ?", (drive_id,)).fetchone()
+            url = row[0] if row and row[0] else f'/drives/{drive_id}/root/delta?$select={self.DELTA_SELECT}'
+            changed = 0
+            deleted_ids = []
+            
+            while url:
+                response = get_graph_client().get(url, token)
+                if response.status_code == 410:
+                    # The delta token expired; start over with a full enumeration
+                    self.reset(drive_id)
+                    url = f'/drives/{drive_id}/root/delta?$select={self.DELTA_SELECT}'
+                    continue
+                if response.status_code != 200:
+                    return changed, deleted_ids, f"Delta sync failed: {response.status_code} - {response.text}"
+                
+                page = response.json()
+                with self._lock:
+                    for item in page.get('value', []):
+                        if 'deleted' in item:
+                            deleted_ids.extend(self._delete(drive_id, item['id']))
+                        else:
+                            self._upsert(drive_id, item)
+                        changed += 1
+                    
+                    if '@odata.deltaLink' in page:
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO mirror_state (drive_id, delta_link, synced_at) VALUES (?, ?, ?)",
+                            (drive_id, page['@odata.deltaLink'], time.time())
+                        )
+                    self._conn.commit()
+                url = page.get('@odata.nextLink')
+            
+            return changed, deleted_ids, None
+    
+    def reset(self, drive_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM mirror_items WHERE drive_id = ?", (drive_id,))
+            self._conn.execute("DELETE FROM mirror_state WHERE drive_id = ?", (drive_id,))
+            self._conn.commit()
+    
+    def _upsert(self, drive_id, item):
+        parent_id = item.get('parentReference', {}).get('id')
+        if 'root' in item:
+            path = ''
+        else:
+            parent = self._conn.execute(
+                "SELECT path FROM mirror_items WHERE drive_id = ? AND item_id = ?", (drive_id, parent_id)
+            ).fetchone()
+            parent_path = parent[0] if parent else ''
+            path = f"{parent_path}/{item['name']}" if parent_path else item['name']
+        
+        previous = self._conn.execute(
+            "SELECT path FROM mirror_items WHERE drive_id = ? AND item_id = ?", (drive_id, item['id'])
+        ).fetchone()
+        
+        file_info = item.get('file') or {}
+        self._conn.execute(
+            "INSERT OR REPLACE INTO mirror_items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                drive_id, item['id'], parent_id, item.get('name', ''), path, path.casefold(),
+                1 if 'folder' in item or 'root' in item else 0, item.get('size'),
+                (file_info.get('hashes') or {}).get('quickXorHash'), item.get('lastModifiedDateTime')
+            )
+        )
+        
+        # A renamed or moved folder carries its descendants with it
+        if previous and previous[0] != path and previous[0]:
+            for item_id, child_path in self._conn.execute(
+                "SELECT item_id, path FROM mirror_items WHERE drive_id = ? AND substr(path, 1, ?) = ?",
+                (drive_id, len(previous[0]) + 1, previous[0] + '/')
+            ).fetchall():
+                new_path = path + child_path[len(previous[0]):]
+                self._conn.execute(
+                    "UPDATE mirror_items SET path = ?, path_key = ? WHERE drive_id = ? AND item_id = ?",
+                    (new_path, new_path.casefold(), drive_id, item_id)
+                )
+    
+    def _delete(self, drive_id, item_id):
+        """Remove an item and its descendants; returns the removed item IDs"""
+        row = self._conn.execute(
+            "SELECT path FROM mirror_items WHERE drive_id = ? AND item_id = ?", (drive_id, item_id)
+        ).fetchone()
+        removed = [item_id]
+        if row and row[0]:
+            removed += [child_id for (child_id,) in self._conn.execute(
+                "SELECT item_id FROM mirror_items WHERE drive_id = ? AND substr(path, 1, ?) = ?",
+                (drive_id, len(row[0]) + 1, row[0] + '/')
+            ).fetchall()]
+        self._conn.executemany(
+            "DELETE FROM mirror_items WHERE drive_id = ? AND item_id = ?", [(drive_id, removed_id) for removed_id in removed]
+        )
+        return removed
+    
+    def forget_folder(self, drive_id, segments):
+        """Drop a folder path and everything under it, e.g. after SharePoint reports it missing"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT item_id FROM mirror_items WHERE drive_id = ? AND is_folder = 1 AND path_key = ?",
+                (drive_id, '/'.join(segments).casefold())
+            ).fetchone()
+            if row:
+                self._delete(drive_id, row[0])
+                self._conn.commit()
+    
+    def folder_ids(self, drive_id, segments):
+        """Return the item IDs of the leading prefixes of `segments` that exist in the mirror"""
+        keys = ['/'.join(segments[:depth]).casefold() for depth in range(1, len(segments) + 1)]
+        if not keys:
+            return []
+        with self._lock:
+            found = dict(self._conn.execute(
+                f"SELECT path_key, item_id FROM mirror_items WHERE drive_id = ? AND is_folder = 1 AND path_key IN ({','.join('?' * len(keys))})",
+                [drive_id] + keys
+            ).fetchall())
+        ids = []
+        for key in keys:
+            if key not in found:
+                break
+            ids.append(found[key])
+        return ids
+    
+    def files_in_folder(self, drive_id, folder_path):
+        """List (item_id, name, quick_xor_hash, last_modified) for the files directly in a folder"""
+        with self._lock:
+            return self._conn.execute(
+                """
+                SELECT file.item_id, file.name, file.quick_xor_hash, file.last_modified
+                FROM mirror_items AS folder
+                JOIN mirror_items AS file
+                    ON file.drive_id = folder.drive_id AND file.parent_id = folder.item_id AND file.is_folder = 0
+                WHERE folder.drive_id = ? AND folder.is_folder = 1 AND folder.path_key = ?
+                ORDER BY file.name
+                """,
+                (drive_id, '/'.join(split_folder_path(folder_path)).casefold())
+            ).fetchall()
+    
+    def photos_per_order(self, drive_id):
+        """Count files and bytes per CustomerName/Status/OrderID folder"""
+        with self._lock:
+            return pd.read_sql_query(
+                """
+                SELECT folder.path AS Folder, COUNT(file.item_id) AS Files, COALESCE(SUM(file.size), 0) AS Bytes,
+                       MAX(file.last_modified) AS LastModified
+                FROM mirror_items AS folder
+                LEFT JOIN mirror_items AS file
+                    ON file.drive_id = folder.drive_id AND file.parent_id = folder.item_id AND file.is_folder = 0
+                WHERE folder.drive_id = ? AND folder.is_folder = 1
+                    AND length(folder.path) - length(replace(folder.path, '/', '')) = 2
+                GROUP BY folder.item_id
+                ORDER BY folder.path
+                """,
+                self._conn,
+                params=(drive_id,)
+            )
+
+@st.cache_resource
+def get_drive_mirror():
+    """Open the process-wide library mirror"""
+    return DriveMirror(SHAREPOINT_INDEX_DB)
+
+def sync_drive_mirror(token, drive_id, force=False):
+    """Bring the local library mirror up to date if it is stale. Returns (changed_count, error)"""
+    mirror = get_drive_mirror()
+    if not force and time.time() - mirror.last_synced(drive_id) < MIRROR_SYNC_INTERVAL:
+        return 0, None
+    try:
+        changed, deleted_ids, error = mirror.sync(token, drive_id)
+    except Exception as e:
+        return 0, f"Error syncing library mirror: {str(e)}"
+    
+    # Deleted files must not be treated as already uploaded
+    if deleted_ids:
+        get_upload_index().forget_items(deleted_ids)
+    return changed, error
+
+# Thumbnails
+@st.cache_resource
+def get_thumbnail_cache():
+    """Open the process-wide on-disk thumbnail cache"""
+    return DiskLRUCache(THUMBNAIL_FOLDER, THUMBNAIL_CACHE_MAX_BYTES)
+
+def get_thumbnail(image_data, max_size=THUMBNAIL_SIZE, content_hash=None):
+    """Return a cached thumbnail for image bytes, generating it once per content hash.
+
+    Pass `content_hash` (the SHA-256 hex digest of image_data) if it is
+    already known, e.g. from uploaded_file_hash, to skip hashing the bytes.
+    """
+    key = f"{content_hash or hashlib.sha256(image_data).hexdigest()}-{max_size}"
+    return get_thumbnail_cache().get_or_create(key, lambda: make_thumbnail(image_data, max_size))
+
+def uploaded_file_hash(uploaded_file):
+    """SHA-256 hex digest of an uploaded file, computed once per upload and kept in session state.
+
+    Streamlit reruns the script on every widget change, and an upload's
+    content never changes for its file_id, so reruns reuse the digest.
+    """
+    hashes = st.session_state.setdefault('upload_hashes', {})
+    if uploaded_file.file_id not in hashes:
+        hashes[uploaded_file.file_id] = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+    return hashes[uploaded_file.file_id]
+
+def get_sharepoint_thumbnail(token, drive_id, item_id, content_hash, max_size=THUMBNAIL_SIZE):
+    """Return a cached thumbnail for a SharePoint file, downloading it only on a cache miss.
+
+    `content_hash` is the file's quickXorHash (or any value that changes
+    with its content), so the file is never downloaded twice.
+    """
+    key = f"{hashlib.sha256(f'{drive_id}:{content_hash}'.encode()).hexdigest()}-{max_size}"
+    
+    def download():
+        response = get_graph_client().get(f'/drives/{drive_id}/items/{item_id}/content', token)
+        return make_thumbnail(response.content, max_size) if response.status_code == 200 else None
+    
+    return get_thumbnail_cache().get_or_create(key, download)
+
+def show_thumbnail_grid(thumbnails, columns=4):
+    """Show (caption, thumbnail) pairs in a grid, skipping files that are not images"""
+    thumbnails = [(caption, thumbnail) for caption, thumbnail in thumbnails if thumbnail]
+    for start in range(0, len(thumbnails), columns):
+        for column, (caption, thumbnail) in zip(st.columns(columns), thumbnails[start:start + columns]):
+            column.image(thumbnail, caption=caption, use_container_width=True)
+
+def show_image_previews(uploaded_files):
+    """Show cached thumbnails of uploaded files"""
+    show_thumbnail_grid([
+        (uploaded_file.name, get_thumbnail(uploaded_file.getbuffer(), content_hash=uploaded_file_hash(uploaded_file)))
+        for uploaded_file in uploaded_files
+    ])
+
+def show_order_photo_gallery(token, drive_id, folder_path):
+    """Show thumbnails of the photos already uploaded to a SharePoint folder"""
+    _, error = sync_drive_mirror(token, drive_id)
+    if error:
+        st.error(error)
+        return
+    
+    files = [row for row in get_drive_mirror().files_in_folder(drive_id, folder_path)
+             if os.path.splitext(row[1])[1].lower() in OPTIMIZABLE_IMAGE_EXTENSIONS + ['.webp', '.avif']]
+    if not files:
+        st.info("No photos uploaded yet")
+        return
+    
+    max_workers = max(1, min(SHAREPOINT_UPLOAD_CONCURRENCY, len(files)))
+    with ThreadPoolExecutor(max_workers=max_workers, initializer=_script_thread_initializer()) as executor:
+        thumbnails = list(executor.map(
+            lambda row: get_sharepoint_thumbnail(token, drive_id, row[0], row[2] or f"{row[0]}:{row[3]}"), files
+        ))
+    
+    show_thumbnail_grid([(row[1], thumbnail) for row, thumbnail in zip(files, thumbnails)])
+
+def show_logo():
+    """Display the logo at the left, resized once and served from the thumbnail cache"""
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        with open(LOGO_PATH, 'rb') as file:
+            logo = get_thumbnail(file.read(), LOGO_WIDTH)
+        st.image(logo, width=LOGO_WIDTH)
+
+# Near-duplicate photos
+class PhotoHashIndex:
+    """Perceptual hashes of photos already sent, per project or order.
+
+    Hashes are stored in SQLite and loaded into an in-memory BK-tree per
+    scope on first use, so checking a batch against the history never
+    scans it. Entries older than NEAR_DUPLICATE_HISTORY_DAYS are ignored.
+    """
+    
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._trees = {}
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS photo_hashes (
+            scope TEXT NOT NULL,
+            photo_hash TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS photo_hashes_scope ON photo_hashes (scope, created_at)")
+        self._conn.commit()
+    
+    def _tree(self, scope):
+        if scope not in self._trees:
+            tree = BKTree()
+            for photo_hash, file_name in self._conn.execute(
+                "SELECT photo_hash, file_name FROM photo_hashes WHERE scope = ? AND created_at > ?",
+                (scope, time.time() - NEAR_DUPLICATE_HISTORY_DAYS * 86400)
+            ):
+                tree.add(int(photo_hash, 16), file_name)
+            self._trees[scope] = tree
+        return self._trees[scope]
+    
+    def find_duplicates(self, scope, hashes):
+        """Flag hashes that match an earlier one in the batch or in the scope's history.
+
+        Returns {index: (distance, match)} as find_near_duplicates.
+        """
+        with self._lock:
+            return find_near_duplicates(hashes, NEAR_DUPLICATE_MAX_DISTANCE, self._tree(scope))
+    
+    def record(self, scope, photos):
+        """Remember (file_name, photo_hash) pairs that were sent for a scope"""
+        photos = [(file_name, photo_hash) for file_name, photo_hash in photos if photo_hash is not None]
+        with self._lock:
+            now = time.time()
+            self._conn.executemany(
+                "INSERT INTO photo_hashes VALUES (?, ?, ?, ?)",
+                [(scope, f"{photo_hash:016x}", file_name, now) for file_name, photo_hash in photos]
+            )
+            self._conn.execute(
+                "DELETE FROM photo_hashes WHERE created_at <= ?", (now - NEAR_DUPLICATE_HISTORY_DAYS * 86400,)
+            )
+            self._conn.commit()
+            if scope in self._trees:
+                for file_name, photo_hash in photos:
+                    self._trees[scope].add(photo_hash, file_name)
+
+@st.cache_resource
+def get_photo_hash_index():
+    """Open the process-wide perceptual hash history"""
+    return PhotoHashIndex(PHOTO_HASH_DB)
+
+@st.cache_data(max_entries=1000, show_spinner=False)
+def photo_hash(content_hash, _image_data):
+    """Perceptual hash of image bytes, or None for files that are not images.
+
+    Cached by content_hash; the (possibly large) image buffer itself is not
+    hashed by Streamlit.
+    """
+    return difference_hash(_image_data)
+
+def flag_near_duplicates(scope, uploaded_files):
+    """Warn about near-duplicate photos in an upload and return them.
+
+    Returns (duplicates, hashes) where duplicates is {index: description}
+    and hashes are the perceptual hashes in upload order.
+    """
+    hashes = [
+        photo_hash(uploaded_file_hash(uploaded_file), uploaded_file.getbuffer())
+        if os.path.splitext(uploaded_file.name)[1].lower() in OPTIMIZABLE_IMAGE_EXTENSIONS else None
+        for uploaded_file in uploaded_files
+    ]
+    matches = get_photo_hash_index().find_duplicates(scope, hashes)
+    duplicates = {
+        index: f"looks like {uploaded_files[match].name}" if isinstance(match, int) else f"looks like {match}, sent earlier"
+        for index, (_, match) in matches.items()
+    }
+    if duplicates:
+        st.warning(f"⚠️ {len(duplicates)} photo(s) look like near-duplicates:")
+        for index, description in duplicates.items():
+            st.write(f"- {uploaded_files[index].name} {description}")
+    return duplicates, hashes
+
+def _header_value(headers, name):
+    """Case-insensitive header lookup for $batch sub-responses"""
+    return next((value for key, value in headers.items() if key.lower() == name.lower()), None)
+
+def graph_batch(token, batch_requests):
+    """Send Graph requests through the $batch endpoint, GRAPH_BATCH_LIMIT at a time.
+
+    Each request is a dict with 'id', 'method' and 'url' (relative to the
+    Graph version root) plus optional 'body', 'headers' and 'dependsOn'.
+    Chunks are sent in order, so a dependency on a request from an earlier
+    chunk is already satisfied and is dropped. Returns (responses, error)
+    where responses maps request id to {'status', 'headers', 'body'}.
+    """
+    responses = {}
+    try:
+        for start in range(0, len(batch_requests), GRAPH_BATCH_LIMIT):
+            chunk = []
+            chunk_ids = set()
+            for request in batch_requests[start:start + GRAPH_BATCH_LIMIT]:
+                request = dict(request)
+                if 'body' in request:
+                    request['headers'] = {'Content-Type': 'application/json', **request.get('headers', {})}
+                depends_on = [request_id for request_id in request.pop('dependsOn', []) if request_id in chunk_ids]
+                if depends_on:
+                    request['dependsOn'] = depends_on
+                chunk.append(request)
+                chunk_ids.add(request['id'])
+            
+            for attempt in range(GRAPH_MAX_RETRIES + 1):
+                response = get_graph_client().post('/$batch', token, json={'requests': chunk})
+                if response.status_code != 200:
+                    return responses, f"Batch request failed: {response.status_code} - {response.text}"
+                
+                for item in response.json().get('responses', []):
+                    responses[item.get('id')] = {
+                        'status': item.get('status'),
+                        'headers': item.get('headers', {}),
+                        'body': item.get('body') or {}
+                    }
+                
+                # Individual requests can be throttled; resend them with the ones that failed (424) only
+                # because they depended on them. Other 424s are left to the caller, without backoff
+                throttled_ids = {request['id'] for request in chunk if responses[request['id']]['status'] in [429, 503]}
+                if not throttled_ids or attempt == GRAPH_MAX_RETRIES:
+                    break
+                retry_ids = set(throttled_ids)
+                for request in chunk:
+                    if responses[request['id']]['status'] == 424 and retry_ids.intersection(request.get('dependsOn', [])):
+                        retry_ids.add(request['id'])
+                get_graph_client().limiter.on_throttle()
+                time.sleep(max(
+                    _retry_delay(_header_value(responses[request_id]['headers'], 'Retry-After'), attempt)
+                    for request_id in throttled_ids
+                ))
+                retry_chunk = []
+                for request in chunk:
+                    if request['id'] not in retry_ids:
+                        continue
+                    request = dict(request)
+                    depends_on = [request_id for request_id in request.pop('dependsOn', []) if request_id in retry_ids]
+                    if depends_on:
+                        request['dependsOn'] = depends_on
+                    retry_chunk.append(request)
+                chunk = retry_chunk
+        
+        return responses, None
+        
+    except Exception as e:
+        return responses, f"Error sending batch request: {str(e)}"
+
 # SharePoint Helper Functions
-@st.cache_data(ttl=3500)  # Cache token for ~58 minutes (tokens usually last 60 minutes)
+class TokenProvider:
+    """Process-wide Graph access token holder.
+
+    Keeps one MSAL application (and its in-memory token cache) and renews
+    the token on a background thread shortly before it expires, so callers
+    normally get a cached token without a network round-trip. Concurrent
+    callers that do need a token share a single request to the identity
+    endpoint.
+    """
+    
+    # MSAL treats tokens within 5 minutes of expiry as expired, so refreshing
+    # inside that window returns a new token instead of the cached one
+    REFRESH_MARGIN = 240
+    RETRY_DELAY = 30
+    
+    def __init__(self, client_id, client_secret, tenant_id, scopes):
+        self._app = msal.ConfidentialClientApplication(
+            client_id=client_id,
+            client_credential=client_secret,
+            authority=f"https://login.microsoftonline.com/{tenant_id}"
+        )
+        self._scopes = scopes
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+        self._refresher = None
+    
+    def get_token(self):
+        """Return (token, error), renewing only if the cached token is about to expire"""
+        if self._token and time.time() < self._expires_at - 60:
+            return self._token, None
+        with self._lock:
+            if self._token and time.time() < self._expires_at - 60:
+                return self._token, None
+            return self._acquire()
+    
+    def _acquire(self):
+        result = self._app.acquire_token_for_client(scopes=self._scopes)
+        if "access_token" not in result:
+            return None, f"Error getting token: {result.get('error_description', 'Unknown error')}"
+        
+        self._token = result["access_token"]
+        self._expires_at = time.time() + int(result.get("expires_in", 3599))
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="graph-token-refresh", daemon=True)
+            self._refresher.start()
+        return self._token, None
+    
+    def _refresh_loop(self):
+        delay = self._expires_at - self.REFRESH_MARGIN - time.time()
+        while True:
+            time.sleep(max(delay, 1))
+            try:
+                with self._lock:
+                    _, error = self._acquire()
+            except Exception as e:
+                error = str(e)
+            if error:
+                delay = self.RETRY_DELAY
+            else:
+                delay = self._expires_at - self.REFRESH_MARGIN - time.time()
+
+@st.cache_resource
+def get_token_provider():
+    """Create the process-wide token provider"""
+    return TokenProvider(SHAREPOINT_CLIENT_ID, SHAREPOINT_CLIENT_SECRET, SHAREPOINT_TENANT_ID, SHAREPOINT_SCOPES)
+
 def get_sharepoint_access_token():
     """Get access token for SharePoint using client credentials flow"""
     try:
         if not all([SHAREPOINT_CLIENT_ID, SHAREPOINT_CLIENT_SECRET, SHAREPOINT_TENANT_ID]):
             return None, "SharePoint credentials not configured"
-            
-        app = msal.ConfidentialClientApplication(
-            client_id=SHAREPOINT_CLIENT_ID,
-            client_credential=SHAREPOINT_CLIENT_SECRET,
-            authority=f"https://login.microsoftonline.com/{SHAREPOINT_TENANT_ID}"
-        )
         
-        result = app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
-        
-        if "access_token" in result:
-            return result["access_token"], None
-        else:
-            return None, f"Error getting token: {result.get('error_description', 'Unknown error')}"
+        return get_token_provider().get_token()
     except Exception as e:
         return None, f"Error in authentication: {str(e)}"
 
 def get_shopify_orders_drive_id(token):
     """Get the drive ID for the Shopify_orders_photos library"""
     try:
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
-        
-        response = requests.get('https://graph.microsoft.com/v1.0/sites/root/drives', headers=headers)
-        
-        if response.status_code == 200:
-            drives_data = response.json()
-            
-            for drive in drives_data.get('value', []):
-                if drive.get('name') == 'Shopify_orders_photos':
-                    return drive.get('id'), None
-                    
-            return None, "Shopify_orders_photos library not found"
-        else:
-            return None, f"Failed to get drives: {response.status_code} - {response.text}"
-            
+        return get_graph_client().get_drive_id(token, SHAREPOINT_DRIVE_NAME)
     except Exception as e:
         return None, f"Error getting drive ID: {str(e)}"
 
-def create_sharepoint_folder(token, drive_id, parent_folder_id, folder_name):
+def create_sharepoint_folder(token, drive_id, parent_folder_id, folder_name, conflict_behavior="rename"):
     """Create a folder in SharePoint"""
     try:
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
-        
         folder_data = {
             "name": folder_name,
             "folder": {},
-            "@microsoft.graph.conflictBehavior": "rename"
+            "@microsoft.graph.conflictBehavior": conflict_behavior
         }
         
         if parent_folder_id == "root":
-            url = f'https://graph.microsoft.com/v1.0/drives/{drive_id}/root/children'
+            url = f'/drives/{drive_id}/root/children'
         else:
-            url = f'https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{parent_folder_id}/children'
+            url = f'/drives/{drive_id}/items/{parent_folder_id}/children'
         
-        response = requests.post(url, headers=headers, json=folder_data)
+        response = get_graph_client().post(url, token, json=folder_data)
         
         if response.status_code == 201:
             created_folder = response.json()
@@ -202,100 +1070,357 @@ def create_sharepoint_folder(token, drive_id, parent_folder_id, folder_name):
     except Exception as e:
         return None, f"Error creating folder: {str(e)}"
 
-@st.cache_data(ttl=300)  # Cache folder paths for 5 minutes
-def get_or_create_folder_path(token, drive_id, folder_path):
-    """Get or create a folder path in SharePoint (e.g., 'CustomerName/Status/OrderID')"""
+def _folder_path_url(drive_id, parent_folder_id, relative_path):
+    """Path-addressed Graph URL for an item below a parent folder"""
+    if not relative_path:
+        if parent_folder_id == "root":
+            return f'/drives/{drive_id}/root'
+        return f'/drives/{drive_id}/items/{parent_folder_id}'
+    quoted_path = urllib.parse.quote(relative_path)
+    if parent_folder_id == "root":
+        return f'/drives/{drive_id}/root:/{quoted_path}'
+    return f'/drives/{drive_id}/items/{parent_folder_id}:/{quoted_path}'
+
+def get_sharepoint_folder_by_path(token, drive_id, parent_folder_id, relative_path):
+    """Look up a folder by path relative to a parent folder. Returns (item_id, error); item_id is None if missing"""
     try:
-        folders = folder_path.strip('/').split('/')
-        current_folder_id = "root"
+        url = _folder_path_url(drive_id, parent_folder_id, relative_path)
+        response = get_graph_client().get(url, token, params={'$select': 'id,folder'})
         
-        for folder_name in folders:
-            if not folder_name:  # Skip empty folder names
-                continue
-                
-            # Try to find existing folder first
-            headers = {
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json'
-            }
-            
-            if current_folder_id == "root":
-                url = f'https://graph.microsoft.com/v1.0/drives/{drive_id}/root/children'
-            else:
-                url = f'https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{current_folder_id}/children'
-            
-            response = requests.get(url, headers=headers)
+        if response.status_code == 200:
+            item = response.json()
+            if 'folder' not in item:
+                return None, f"'{relative_path}' exists but is not a folder"
+            return item.get('id'), None
+        elif response.status_code == 404:
+            return None, None
+        else:
+            return None, f"Failed to look up folder: {response.status_code} - {response.text}"
             
-            folder_found = False
-            if response.status_code == 200:
-                items = response.json().get('value', [])
-                for item in items:
-                    if item.get('name') == folder_name and 'folder' in item:
-                        current_folder_id = item.get('id')
-                        folder_found = True
-                        break
+    except Exception as e:
+        return None, f"Error looking up folder: {str(e)}"
+
+def get_or_create_folder_path(token, drive_id, folder_path, _retried=False):
+    """Get or create a folder path in SharePoint (e.g., 'CustomerName/Status/OrderID')
+
+    Lookups for all missing segments go out in one $batch call, and the
+    creates for the ones that don't exist go out in a second, chained with
+    dependsOn. If a cached parent folder turns out to be deleted, it is
+    dropped from the index and the mirror and the path is resolved again,
+    once.
+    """
+    try:
+        segments = split_folder_path(folder_path)
+        index = get_folder_index()
+        mirror = get_drive_mirror()
+        
+        # Resolve from the deepest folder already in the local index
+        depth, parent_id = index.deepest_ancestor(drive_id, segments)
+        if depth < len(segments) and time.time() - mirror.last_synced(drive_id) < MIRROR_SYNC_INTERVAL:
+            # Folders a recently synced library mirror knows about need no Graph call
+            for mirror_depth, folder_id in enumerate(mirror.folder_ids(drive_id, segments), start=1):
+                if mirror_depth > depth:
+                    index.store(drive_id, segments[:mirror_depth], folder_id)
+                    depth, parent_id = mirror_depth, folder_id
+        missing = segments[depth:]
+        if not missing:
+            return parent_id, None
+        
+        # Look up every missing prefix at once
+        lookups = [
+            {
+                'id': str(count),
+                'method': 'GET',
+                'url': _folder_path_url(drive_id, parent_id, '/'.join(missing[:count])) + '?$select=id,folder'
+            }
+            for count in range(1, len(missing) + 1)
+        ]
+        responses, error = graph_batch(token, lookups)
+        if error:
+            return None, f"Error finding folders: {error}"
+        
+        existing = 0
+        current_folder_id = parent_id
+        for count in range(1, len(missing) + 1):
+            response = responses.get(str(count), {})
+            if response.get('status') != 200:
+                break
+            if 'folder' not in response['body']:
+                return None, f"'{'/'.join(segments[:depth + count])}' exists but is not a folder"
+            existing = count
+            current_folder_id = response['body'].get('id')
+            index.store(drive_id, segments[:depth + count], current_folder_id)
+        
+        if existing == len(missing):
+            return current_folder_id, None
+        
+        # Create the remaining folders in order, each one inside the previous
+        creates = []
+        for count in range(existing + 1, len(missing) + 1):
+            parent_path = '/'.join(missing[existing:count - 1])
+            request = {
+                'id': str(count),
+                'method': 'POST',
+                'url': _folder_path_url(drive_id, current_folder_id, parent_path) + ('/children' if not parent_path else ':/children'),
+                'body': {
+                    "name": missing[count - 1],
+                    "folder": {},
+                    "@microsoft.graph.conflictBehavior": "fail"
+                }
+            }
+            if creates:
+                request['dependsOn'] = [creates[-1]['id']]
+            creates.append(request)
+        
+        responses, error = graph_batch(token, creates)
+        if error:
+            return None, f"Error creating folders: {error}"
+        
+        for count in range(existing + 1, len(missing) + 1):
+            folder_name = missing[count - 1]
+            response = responses.get(str(count), {})
+            status = response.get('status')
             
-            # Create folder if not found
-            if not folder_found:
-                new_folder_id, error = create_sharepoint_folder(token, drive_id, current_folder_id, folder_name)
+            if status == 201:
+                current_folder_id = response['body'].get('id')
+            elif status == 409:
+                # Created by someone else in the meantime
+                current_folder_id, error = get_sharepoint_folder_by_path(token, drive_id, current_folder_id, folder_name)
+                if error or not current_folder_id:
+                    return None, f"Error creating folder '{folder_name}': {error}"
+            elif status == 424:
+                # An earlier create in the chain hit a conflict; create this one directly
+                current_folder_id, error = create_sharepoint_folder(token, drive_id, current_folder_id, folder_name, "fail")
                 if error:
                     return None, f"Error creating folder '{folder_name}': {error}"
-                current_folder_id = new_folder_id
+            elif status == 404 and depth > 0 and count == existing + 1 and not _retried:
+                # The cached parent no longer exists, and if a customer folder was deleted or renamed its
+                # cached ancestors are stale too; drop every cached prefix so the retry resolves from the root
+                index.invalidate(drive_id, segments[:1])
+                mirror.forget_folder(drive_id, segments[:1])
+                return get_or_create_folder_path(token, drive_id, folder_path, _retried=True)
+            else:
+                return None, f"Error creating folder '{folder_name}': {status} - {response.get('body')}"
+            
+            index.store(drive_id, segments[:depth + count], current_folder_id)
         
         return current_folder_id, None
         
     except Exception as e:
         return None, f"Error creating folder path: {str(e)}"
 
-def upload_file_to_sharepoint(token, drive_id, folder_id, file_path, file_name):
-    """Upload a file to SharePoint from file path"""
-    try:
-        headers = {
-            'Authorization': f'Bearer {token}',
-        }
+def precreate_folder_paths(token, drive_id, folder_paths):
+    """Create many folder paths in bulk, one $batch round per folder level.
+
+    Folders already in the local index are skipped. Returns (resolved_count, errors).
+    """
+    index = get_folder_index()
+    all_segments = {}
+    for folder_path in folder_paths:
+        segments = split_folder_path(folder_path)
+        for depth in range(1, len(segments) + 1):
+            all_segments.setdefault(_folder_index_key(segments[:depth]), segments[:depth])
+    
+    resolved = 0
+    errors = []
+    max_depth = max((len(segments) for segments in all_segments.values()), default=0)
+    for depth in range(1, max_depth + 1):
+        # Parents are resolved by the previous round, so their IDs are in the index
+        pending = {}
+        for segments in all_segments.values():
+            if len(segments) != depth or index.deepest_ancestor(drive_id, segments)[0] == depth:
+                continue
+            parent_depth, parent_id = index.deepest_ancestor(drive_id, segments[:-1])
+            if parent_depth != depth - 1:
+                continue  # Parent failed to resolve
+            pending[str(len(pending))] = (segments, parent_id)
         
-        # Read file content
-        with open(file_path, 'rb') as file:
-            file_content = file.read()
+        creates = [
+            {
+                'id': request_id,
+                'method': 'POST',
+                'url': _folder_path_url(drive_id, parent_id, '') + '/children',
+                'body': {
+                    "name": segments[-1],
+                    "folder": {},
+                    "@microsoft.graph.conflictBehavior": "fail"
+                }
+            }
+            for request_id, (segments, parent_id) in pending.items()
+        ]
+        responses, error = graph_batch(token, creates)
+        if error:
+            errors.append(error)
+            break
         
-        # Upload file
-        if folder_id == "root":
-            url = f'https://graph.microsoft.com/v1.0/drives/{drive_id}/root:/{file_name}:/content'
-        else:
-            url = f'https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}:/{file_name}:/content'
+        # Folders that already existed are looked up by path in one more batch
+        lookups = []
+        for request_id, (segments, parent_id) in pending.items():
+            response = responses.get(request_id, {})
+            if response.get('status') == 201:
+                index.store(drive_id, segments, response['body'].get('id'))
+                resolved += 1
+            elif response.get('status') == 409:
+                lookups.append({
+                    'id': request_id,
+                    'method': 'GET',
+                    'url': _folder_path_url(drive_id, parent_id, segments[-1]) + '?$select=id'
+                })
+            else:
+                errors.append(f"{'/'.join(segments)}: {response.get('status')} - {response.get('body')}")
+        
+        responses, error = graph_batch(token, lookups)
+        if error:
+            errors.append(error)
+            break
+        for request in lookups:
+            segments = pending[request['id']][0]
+            response = responses.get(request['id'], {})
+            if response.get('status') == 200:
+                index.store(drive_id, segments, response['body'].get('id'))
+                resolved += 1
+            else:
+                errors.append(f"{'/'.join(segments)}: {response.get('status')} - {response.get('body')}")
+    
+    return resolved, errors
+
+def precreate_shopify_order_folders(token, drive_id, statuses=None):
+    """Create the CustomerName/Status/OrderID folders for every order in ShopifyProjectData"""
+    orders_df = get_shopify_projects_from_db()
+    folder_paths = [
+        f"{row['CustomerName']}/{status}/{row['OrderID']}"
+        for _, row in orders_df.iterrows()
+        if row['CustomerName'] and row['OrderID']
+        for status in (statuses or SHOPIFY_FOLDER_STATUSES)
+    ]
+    return precreate_folder_paths(token, drive_id, folder_paths)
+
+def invalidate_folder_path(drive_id, folder_path):
+    """Drop a folder path, its parents and everything cached below them from the local index and mirror.
+
+    Used after SharePoint reports the path missing: whichever ancestor was
+    deleted or renamed, the next lookup then resolves it from the root.
+    """
+    top_level = split_folder_path(folder_path)[:1]
+    get_folder_index().invalidate(drive_id, top_level)
+    get_drive_mirror().forget_folder(drive_id, top_level)
+
+def _sharepoint_item_url(drive_id, folder_id, file_name):
+    """Build the path-addressed Graph URL for a file inside a folder (without the action suffix)"""
+    quoted_name = urllib.parse.quote(file_name)
+    if folder_id == "root":
+        return f'/drives/{drive_id}/root:/{quoted_name}:'
+    return f'/drives/{drive_id}/items/{folder_id}:/{quoted_name}:'
+
+def create_sharepoint_upload_session(token, drive_id, folder_id, file_name):
+    """Create a resumable upload session and return its upload URL"""
+    try:
+        session_data = {
+            "item": {
+                "@microsoft.graph.conflictBehavior": "replace"
+            }
+        }
         
-        response = requests.put(url, headers=headers, data=file_content)
+        url = f'{_sharepoint_item_url(drive_id, folder_id, file_name)}/createUploadSession'
+        response = get_graph_client().post(url, token, json=session_data)
         
-        if response.status_code in [200, 201]:
-            uploaded_file = response.json()
-            return uploaded_file.get('webUrl'), None
+        if response.status_code == 200:
+            return response.json().get('uploadUrl'), None
         else:
-            return None, f"Failed to upload file: {response.status_code} - {response.text}"
+            return None, f"Failed to create upload session: {response.status_code} - {response.text}"
             
     except Exception as e:
-        return None, f"Error uploading file: {str(e)}"
+        return None, f"Error creating upload session: {str(e)}"
 
-@st.cache_data(ttl=60)  # Cache for 1 minute to avoid duplicate uploads
-def upload_file_content_to_sharepoint(token, drive_id, folder_id, file_name, file_content):
-    """Upload file content directly to SharePoint"""
-    try:
+def _next_expected_offset(session_status, default):
+    """Read the first byte SharePoint still expects from an upload session status"""
+    ranges = session_status.get('nextExpectedRanges') or []
+    if ranges:
+        return int(ranges[0].split('-')[0])
+    return default
+
+def upload_stream_to_sharepoint(upload_url, stream, total_size, chunk_size=None, max_retries=None):
+    """Upload a seekable stream to an upload session in byte-range chunks.
+
+    Returns (drive_item, error). Only one chunk is held in memory at a time. After a failed chunk the
+    session is queried for the next expected range and the upload resumes
+    from there instead of starting over.
+    """
+    chunk_size = chunk_size or SHAREPOINT_UPLOAD_CHUNK_SIZE
+    max_retries = SHAREPOINT_UPLOAD_MAX_RETRIES if max_retries is None else max_retries
+    offset = 0
+    retries = 0
+    
+    while offset < total_size:
+        stream.seek(offset)
+        chunk = stream.read(min(chunk_size, total_size - offset))
+        end = offset + len(chunk) - 1
+        
+        # Upload URLs are pre-authenticated, so no Authorization header is sent
         headers = {
-            'Authorization': f'Bearer {token}',
+            'Content-Length': str(len(chunk)),
+            'Content-Range': f'bytes {offset}-{end}/{total_size}'
         }
         
-        # Check if it's an image file that can be optimized
-        file_ext = os.path.splitext(file_name)[1].lower()
-        if file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']:
-            # Optimize image before uploading
-            file_content = optimize_image(file_content)
+        try:
+            response = get_graph_client().put(upload_url, headers=headers, data=chunk, timeout=120)
+        except requests.RequestException as e:
+            response = None
+            last_error = f"Error uploading chunk: {str(e)}"
+        
+        if response is not None:
+            if response.status_code in [200, 201]:
+                return response.json(), None
+            if response.status_code == 202:
+                offset = _next_expected_offset(response.json(), end + 1)
+                retries = 0
+                continue
+            if response.status_code == 404:
+                return None, "Upload session expired"
+            last_error = f"Failed to upload chunk: {response.status_code} - {response.text}"
+        
+        retries += 1
+        if retries > max_retries:
+            return None, last_error
+        time.sleep(min(2 ** retries, 30))
+        
+        # Ask the session where to resume
+        try:
+            status = get_graph_client().get(upload_url)
+            if status.status_code == 200:
+                offset = _next_expected_offset(status.json(), offset)
+            elif status.status_code == 404:
+                return None, "Upload session expired"
+        except requests.RequestException:
+            pass  # Retry the same range
+    
+    return None, "Upload session ended without a completed file"
+
+def upload_large_file_to_sharepoint(token, drive_id, folder_id, file_name, stream, total_size):
+    """Upload a seekable stream to SharePoint through a resumable upload session. Returns (drive_item, error)"""
+    upload_url, error = create_sharepoint_upload_session(token, drive_id, folder_id, file_name)
+    if error:
+        return None, error
+    return upload_stream_to_sharepoint(upload_url, stream, total_size)
+
+def upload_file_to_sharepoint(token, drive_id, folder_id, file_path, file_name):
+    """Upload a file to SharePoint from file path"""
+    try:
+        # Stream large files from disk in chunks instead of reading them into memory
+        file_size = os.path.getsize(file_path)
+        if file_size > SHAREPOINT_SIMPLE_UPLOAD_LIMIT:
+            with open(file_path, 'rb') as file:
+                uploaded_file, error = upload_large_file_to_sharepoint(token, drive_id, folder_id, file_name, file, file_size)
+            return (uploaded_file.get('webUrl') if uploaded_file else None), error
+        
+        # Read file content
+        with open(file_path, 'rb') as file:
+            file_content = file.read()
         
         # Upload file
-        if folder_id == "root":
-            url = f'https://graph.microsoft.com/v1.0/drives/{drive_id}/root:/{file_name}:/content'
-        else:
-            url = f'https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}:/{file_name}:/content'
+        url = f'{_sharepoint_item_url(drive_id, folder_id, file_name)}/content'
         
-        response = requests.put(url, headers=headers, data=file_content)
+        response = get_graph_client().put(url, token, data=file_content)
         
         if response.status_code in [200, 201]:
             uploaded_file = response.json()
@@ -306,39 +1431,420 @@ def upload_file_content_to_sharepoint(token, drive_id, folder_id, file_name, fil
     except Exception as e:
         return None, f"Error uploading file: {str(e)}"
 
-def send_email(recipient_email, subject, body, attachments=None):
-    """Send email with optional attachments using Brevo SMTP"""
+def upload_stream_as_file(token, drive_id, folder_id, file_name, stream, total_size):
+    """Upload a seekable stream as one file: a simple PUT when small, an upload session otherwise.
+
+    Returns (drive_item, error).
+    """
+    if total_size > SHAREPOINT_SIMPLE_UPLOAD_LIMIT:
+        return upload_large_file_to_sharepoint(token, drive_id, folder_id, file_name, stream, total_size)
+    
+    url = f'{_sharepoint_item_url(drive_id, folder_id, file_name)}/content'
+    response = get_graph_client().put(url, token, data=stream.read())
+    if response.status_code not in [200, 201]:
+        return None, f"Failed to upload file: {response.status_code} - {response.text}"
+    return response.json(), None
+
+def upload_file_content_to_sharepoint(token, drive_id, folder_id, file_name, file_content, optimize=True):
+    """Upload file content directly to SharePoint, skipping content already uploaded to the same folder.
+
+    `file_content` may be bytes or a memoryview (e.g. UploadedFile.getbuffer()),
+    which is never copied whole. Images are optimized (and stored as
+    SHAREPOINT_IMAGE_FORMAT) unless `optimize` is False; the optimized copy
+    is streamed from disk. Returns (web_url, stored_bytes, error);
+    stored_bytes is 0 when the content was already there.
+    """
     try:
-        # Create message container
-        msg = MIMEMultipart()
-        msg['From'] = f"{EMAIL_SENDER_NAME} <{EMAIL_SENDER}>"
-        msg['To'] = recipient_email
-        msg['Subject'] = subject
-        
-        # Add body to email
-        msg.attach(MIMEText(body, 'html'))
-        
-        # Add attachments
-        if attachments:
-            for file_path in attachments:
-                with open(file_path, 'rb') as file:
-                    # Get the filename from the path
-                    filename = os.path.basename(file_path)
-                    part = MIMEApplication(file.read(), Name=filename)
-                    part['Content-Disposition'] = f'attachment; filename="{filename}"'
-                    msg.attach(part)
-        
-        # Connect to SMTP server and send email
-        server = smtplib.SMTP(BREVO_SMTP_SERVER, BREVO_SMTP_PORT)
-        server.starttls()
-        server.login(BREVO_SMTP_LOGIN, BREVO_SMTP_PASSWORD)
-        server.send_message(msg)
-        server.quit()
+        # Skip files whose exact content is already in this folder
+        upload_index = get_upload_index()
+        content_hash = hashlib.sha256(file_content).hexdigest()
+        web_url = upload_index.lookup(content_hash, drive_id, folder_id)
+        if web_url:
+            return web_url, 0, None
         
-        return True
+        with tempfile.TemporaryDirectory(dir=UPLOAD_FOLDER) as temp_dir:
+            # Check if it's an image file that can be optimized
+            file_ext = os.path.splitext(file_name)[1].lower()
+            if optimize and file_ext in OPTIMIZABLE_IMAGE_EXTENSIONS:
+                # Optimize image before uploading; TIFF and BMP are converted to a compressed format
+                output_format = None if SHAREPOINT_IMAGE_FORMAT == "original" else SHAREPOINT_IMAGE_FORMAT.upper()
+                input_path = os.path.join(temp_dir, "input")
+                output_path = os.path.join(temp_dir, "output")
+                with open(input_path, 'wb') as file:
+                    file.write(file_content)
+                settings = optimize_image_files(
+                    [(input_path, output_path)], transcode=True, output_format=output_format
+                )[0]
+                file_name = output_file_name(file_name, settings)
+                stream = open(output_path, 'rb')
+            else:
+                stream = open_buffer(file_content)
+            
+            # At most one simple upload or one session chunk is read into memory. Optimizing reserves
+            # its own share, so this is not held meanwhile (a thread holding both could wait forever)
+            with stream:
+                stored_bytes = stream.seek(0, io.SEEK_END)
+                stream.seek(0)
+                reserved = min(stored_bytes, max(SHAREPOINT_SIMPLE_UPLOAD_LIMIT, SHAREPOINT_UPLOAD_CHUNK_SIZE))
+                with get_memory_budget().reserve(reserved):
+                    uploaded_file, error = upload_stream_as_file(
+                        token, drive_id, folder_id, file_name, stream, stored_bytes
+                    )
+        if error:
+            return None, 0, error
+        
+        upload_index.record(
+            content_hash, drive_id, folder_id, file_name,
+            uploaded_file.get('id'), uploaded_file.get('webUrl'), stored_bytes
+        )
+        return uploaded_file.get('webUrl'), stored_bytes, None
+            
     except Exception as e:
-        st.error(f"Error sending email: {str(e)}")
-        return False
+        return None, 0, f"Error uploading file: {str(e)}"
+
+def _script_thread_initializer():
+    """Return a thread initializer that attaches the current Streamlit script context"""
+    ctx = get_script_run_ctx()
+
+    def initializer():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    return initializer
+
+def upload_files_to_sharepoint_concurrently(token, drive_id, folder_id, files, max_workers=None, optimize=True):
+    """Upload several files to SharePoint in parallel.
+
+    `files` is a list of (file_name, file_content) pairs, where file_content
+    is bytes or a memoryview. Returns a list of
+    (file_name, web_url, error, bytes_saved) tuples in the same order as
+    `files`. bytes_saved is the original size less the stored size for
+    files actually uploaded, or minus the stored size when `optimize` is
+    False (an extra copy); it is 0 for failed and already-uploaded files.
+    """
+    if not files:
+        return []
+
+    max_workers = max(1, min(max_workers or SHAREPOINT_UPLOAD_CONCURRENCY, len(files)))
+
+    def upload_one(file_name, file_content):
+        try:
+            web_url, stored_bytes, error = upload_file_content_to_sharepoint(
+                token, drive_id, folder_id, file_name, file_content, optimize
+            )
+            if not web_url or not stored_bytes:
+                return file_name, web_url, error, 0
+            return file_name, web_url, error, len(file_content) - stored_bytes if optimize else -stored_bytes
+        except Exception as e:
+            return file_name, None, f"Error uploading file: {str(e)}", 0
+
+    with ThreadPoolExecutor(max_workers=max_workers, initializer=_script_thread_initializer()) as executor:
+        futures = [executor.submit(upload_one, file_name, file_content) for file_name, file_content in files]
+        return [future.result() for future in futures]
+
+def upload_files_to_sharepoint_folder(token, drive_id, folder_path, files):
+    """Resolve (or create) a folder path and upload files into it in parallel.
+
+    If SharePoint reports the indexed folder as missing, the path is
+    re-resolved once and the failed files are retried. With
+    SHAREPOINT_KEEP_ORIGINAL, the untouched images are also uploaded to an
+    Originals subfolder. Returns (results, error) where results is a list
+    of (file_name, web_url, error, bytes_saved); bytes_saved is net of any
+    original kept.
+    """
+    folder_id, error = get_or_create_folder_path(token, drive_id, folder_path)
+    if error:
+        return [], error
+    
+    results = upload_files_to_sharepoint_concurrently(token, drive_id, folder_id, files)
+    
+    missing = [index for index, (_, web_url, upload_error, _) in enumerate(results)
+               if not web_url and upload_error and ": 404 -" in upload_error]
+    if missing:
+        invalidate_folder_path(drive_id, folder_path)
+        folder_id, error = get_or_create_folder_path(token, drive_id, folder_path)
+        if error:
+            return results, None
+        retried = upload_files_to_sharepoint_concurrently(token, drive_id, folder_id, [files[index] for index in missing])
+        for index, result in zip(missing, retried):
+            results[index] = result
+    
+    originals = [(file_name, file_content) for file_name, file_content in files
+                 if os.path.splitext(file_name)[1].lower() in OPTIMIZABLE_IMAGE_EXTENSIONS]
+    if SHAREPOINT_KEEP_ORIGINAL and originals:
+        # The optimized copies are already stored, so a failure here is only reported per file
+        originals_id, error = get_or_create_folder_path(token, drive_id, f"{folder_path}/Originals")
+        original_results = upload_files_to_sharepoint_concurrently(
+            token, drive_id, originals_id, originals, optimize=False
+        ) if not error else [(file_name, None, error, 0) for file_name, _ in originals]
+        for index, (file_name, web_url, upload_error, bytes_saved) in enumerate(results):
+            original = next((result for result in original_results if result[0] == file_name), None)
+            if web_url and original and not original[1]:
+                results[index] = (file_name, web_url, f"Original not kept: {original[2]}", bytes_saved)
+            elif original:
+                # The kept original's storage offsets what optimizing saved
+                results[index] = (file_name, web_url, upload_error, bytes_saved + original[3])
+    
+    return results, None
+
+def encoded_attachment_size(size):
+    """Bytes an attachment adds to a message: base64 with CRLF every 76 characters, plus its MIME headers"""
+    return (size + 2) // 3 * 4 * 78 // 76 + 512
+
+def email_image_budget(other_attachment_bytes, image_count, max_message_bytes=None):
+    """Bytes each image may use so a message stays under the relay's size limit"""
+    max_message_bytes = max_message_bytes or EMAIL_MAX_MESSAGE_BYTES
+    # Attachments grow by 4/3 (plus line breaks) when base64-encoded; keep 64 KB for headers and body
+    attachment_budget = (max_message_bytes - 64 * 1024 - 516 * image_count) * 76 // 78 // 4 * 3 - other_attachment_bytes
+    return max(50 * 1024, attachment_budget // max(1, image_count))
+
+def plan_email_messages(sizes, max_message_bytes=None, max_attachments=None):
+    """Pack attachments into as few messages as possible under the relay's size and count limits.
+
+    `sizes` are attachment sizes in bytes. Uses first-fit decreasing bin
+    packing; an attachment too large to share a message gets one of its
+    own. Returns lists of attachment indices, one per message, in upload
+    order.
+    """
+    # Keep 64 KB of each message for headers and body
+    capacity = (max_message_bytes or EMAIL_MAX_MESSAGE_BYTES) - 64 * 1024
+    max_attachments = max_attachments or EMAIL_MAX_ATTACHMENTS
+    messages = []  # [remaining capacity, attachment indices]
+    for index in sorted(range(len(sizes)), key=lambda index: -sizes[index]):
+        needed = encoded_attachment_size(sizes[index])
+        for message in messages:
+            if needed <= message[0] and len(message[1]) < max_attachments:
+                message[0] -= needed
+                message[1].append(index)
+                break
+        else:
+            messages.append([capacity - needed, [index]])
+    return sorted((sorted(indices) for _, indices in messages), key=lambda indices: indices[0])
+
+def smtp_send_stream(server, from_addr, to_addr, stream, chunk_size=64 * 1024):
+    """Send a message from a binary stream over an open SMTP connection, one chunk at a time.
+
+    smtplib's sendmail needs the whole message in memory; this issues MAIL,
+    RCPT and DATA itself. The stream must already use CRLF line endings
+    and contain no line starting with '.', as write_email_message ensures.
+    """
+    server.ehlo_or_helo_if_needed()
+    code, response = server.mail(from_addr)
+    if code != 250:
+        raise smtplib.SMTPSenderRefused(code, response, from_addr)
+    code, response = server.rcpt(to_addr)
+    if code not in [250, 251]:
+        raise smtplib.SMTPRecipientsRefused({to_addr: (code, response)})
+    code, response = server.docmd('DATA')
+    if code != 354:
+        raise smtplib.SMTPDataError(code, response)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        server.send(chunk)
+    server.send(b'.\r\n')
+    code, response = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+
+def _smtp_connection_lost(error):
+    """True if an SMTP error means the connection is gone (SMTP protocol errors also subclass OSError)"""
+    return isinstance(error, smtplib.SMTPServerDisconnected) or not isinstance(error, smtplib.SMTPException)
+
+class SMTPPool:
+    """Thread-safe pool of authenticated SMTP connections to one relay.
+
+    Connections are opened (connect, STARTTLS, login) on demand, up to
+    `size` at once, and returned to the pool after each message. A pooled
+    connection is checked with NOOP before reuse and dropped once it has
+    been idle for `idle_timeout` seconds; a message that fails on a reused
+    connection because the relay closed it is retried once on a fresh one.
+    """
+    
+    def __init__(self, host, port, login, password, size=4, idle_timeout=240, timeout=60):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []  # (server, last_used) pairs
+        self._lock = threading.Lock()
+    
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls()
+            server.login(self.login, self.password)
+        except Exception:
+            self._close(server)
+            raise
+        return server
+    
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+    
+    def _checkout(self):
+        """Return (server, reused): a live pooled connection if there is one, else a new one"""
+        while True:
+            with self._lock:
+                server, last_used = self._idle.pop() if self._idle else (None, None)
+            if server is None:
+                return self._connect(), False
+            if time.time() - last_used < self.idle_timeout:
+                try:
+                    if server.noop()[0] == 250:
+                        return server, True
+                except OSError:
+                    pass
+            self._close(server)
+    
+    def _checkin(self, server):
+        with self._lock:
+            self._idle.append((server, time.time()))
+    
+    def send_message(self, msg):
+        """Send an email.message.Message over a pooled connection"""
+        self._send(lambda server: server.send_message(msg))
+    
+    def send_file(self, from_addr, to_addr, message_file):
+        """Send a message already written to a binary file (see write_email_message), streaming it to DATA"""
+        def send(server):
+            message_file.seek(0)
+            smtp_send_stream(server, from_addr, to_addr, message_file)
+        self._send(send)
+    
+    def _send(self, send):
+        """Call send(server) with a pooled connection, retrying once on a fresh one if a reused connection was dropped"""
+        with self._slots:
+            server, reused = self._checkout()
+            try:
+                send(server)
+            except OSError as e:
+                if not _smtp_connection_lost(e):
+                    # Reset the session so the connection can be reused for the next message
+                    try:
+                        server.rset()
+                    except OSError:
+                        self._close(server)
+                        raise e
+                    self._checkin(server)
+                    raise
+                self._close(server)
+                if not reused:
+                    raise
+                # The relay closed the connection after the NOOP check; start over once
+                server = self._connect()
+                try:
+                    send(server)
+                except Exception:
+                    self._close(server)
+                    raise
+            except Exception:
+                self._close(server)
+                raise
+            self._checkin(server)
+    
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._close(server)
+
+@st.cache_resource
+def get_smtp_pool():
+    """Create the process-wide pool of Brevo SMTP connections"""
+    return SMTPPool(
+        BREVO_SMTP_SERVER, BREVO_SMTP_PORT, BREVO_SMTP_LOGIN, BREVO_SMTP_PASSWORD,
+        size=SMTP_POOL_SIZE, idle_timeout=SMTP_IDLE_TIMEOUT, timeout=SMTP_TIMEOUT
+    )
+
+def _write_base64(output, source, chunk_size):
+    """Base64-encode a binary file into output in 76-character CRLF lines, one chunk at a time"""
+    for chunk in iter(lambda: source.read(chunk_size), b''):
+        output.write(base64.encodebytes(chunk).replace(b'\n', b'\r\n'))
+
+def write_email_message(output, sender, recipient_email, subject, body, attachments=None, chunk_size=None):
+    """Write a multipart email with an HTML body and file attachments to a binary file.
+
+    Attachments are read and base64-encoded chunk by chunk, so only one
+    chunk is in memory at a time. Lines end in CRLF and every part is
+    base64-encoded, so no line starts with '.' and the output can be sent
+    to SMTP DATA as is.
+    """
+    chunk_size = chunk_size or EMAIL_ENCODE_CHUNK_SIZE
+    boundary = f"=============={uuid.uuid4().hex}=="
+    encoded_subject = Header(subject, 'utf-8').encode(linesep='\r\n')
+    headers = [
+        f"From: {sender}",
+        f"To: {recipient_email}",
+        f"Subject: {encoded_subject}",
+        f"Date: {email.utils.formatdate(localtime=True)}",
+        f"Message-ID: {email.utils.make_msgid()}",
+        "MIME-Version: 1.0",
+        f'Content-Type: multipart/mixed; boundary="{boundary}"',
+    ]
+    output.write(("\r\n".join(headers) + "\r\n\r\n").encode())
+    
+    output.write(
+        f'--{boundary}\r\nContent-Type: text/html; charset="utf-8"\r\nContent-Transfer-Encoding: base64\r\n\r\n'.encode()
+    )
+    _write_base64(output, io.BytesIO(body.encode('utf-8')), chunk_size)
+    
+    for file_path in attachments or []:
+        # Get the filename from the path
+        filename = os.path.basename(file_path)
+        output.write((
+            f'--{boundary}\r\n'
+            f'Content-Type: application/octet-stream; Name="{filename}"\r\n'
+            'Content-Transfer-Encoding: base64\r\n'
+            f'Content-Disposition: attachment; filename="{filename}"\r\n\r\n'
+        ).encode())
+        with open(file_path, 'rb') as file:
+            _write_base64(output, file, chunk_size)
+    
+    output.write(f'--{boundary}--\r\n'.encode())
+
+def deliver_email(recipient_email, subject, body, attachments=None):
+    """Send email with optional attachments using Brevo SMTP, raising on failure.
+
+    The message is written to a spooled temporary file (kept in memory up
+    to EMAIL_SPOOL_MAX_BYTES, on disk beyond) and streamed to the relay,
+    so a large batch never has to fit in memory.
+    """
+    with get_memory_budget().reserve(EMAIL_SPOOL_MAX_BYTES + EMAIL_ENCODE_CHUNK_SIZE * 2):
+        with tempfile.SpooledTemporaryFile(max_size=EMAIL_SPOOL_MAX_BYTES, dir=UPLOAD_FOLDER) as message_file:
+            sender = email.utils.formataddr((EMAIL_SENDER_NAME, EMAIL_SENDER))
+            write_email_message(message_file, sender, recipient_email, subject, body, attachments)
+            
+            # Send over a pooled, already authenticated connection
+            get_smtp_pool().send_file(EMAIL_SENDER, recipient_email, message_file)
+
+def send_email_messages(recipient_email, subject, body, attachments):
+    """Split attachments into size-capped messages and send them in parallel over the SMTP pool.
+
+    When more than one message is needed, subjects are numbered, e.g.
+    "PRODUCTION (2/3)". Returns (messages, errors): the attachment paths
+    of each message and, for each, None if it was sent or the error.
+    """
+    sizes = [os.path.getsize(file_path) for file_path in attachments]
+    messages = [[attachments[index] for index in indices] for indices in plan_email_messages(sizes)] or [[]]
+    
+    def send_one(number, message_attachments):
+        numbered_subject = f"{subject} ({number}/{len(messages)})" if len(messages) > 1 else subject
+        try:
+            deliver_email(recipient_email, numbered_subject, body, message_attachments)
+            return None
+        except Exception as e:
+            return f"Error sending email: {str(e)}"
+    
+    max_workers = max(1, min(SMTP_POOL_SIZE, len(messages)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        errors = list(executor.map(send_one, range(1, len(messages) + 1), messages))
+    return messages, errors
 
 # Database connection function
 def get_db_connection():
@@ -559,44 +2065,172 @@ def get_email_for_project(project_id):
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
     
-# Image optimization function
-def optimize_image(image_data, max_size=1800, quality=85):
-    """Optimize image by resizing and compressing"""
-    try:
-        # Open image from bytes
-        img = Image.open(io.BytesIO(image_data))
-        
-        # Check if resize is needed
-        if max(img.size) > max_size:
-            # Calculate new dimensions while preserving aspect ratio
-            if img.size[0] > img.size[1]:  # Width > Height
-                new_width = max_size
-                new_height = int(img.size[1] * (max_size / img.size[0]))
-            else:  # Height > Width
-                new_height = max_size
-                new_width = int(img.size[0] * (max_size / img.size[1]))
-            
-            # Resize with high quality
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-        
-        # Save to buffer with optimization
-        buffer = io.BytesIO()
-        
-        # Save with format-specific optimizations
-        if img.format == 'JPEG' or img.format == 'JPG':
-            img.save(buffer, format=img.format, quality=quality, optimize=True)
-        elif img.format == 'PNG':
-            img.save(buffer, format=img.format, optimize=True)
-        else:
-            # For other formats, just save with default settings
-            img.save(buffer, format=img.format)
-            
-        buffer.seek(0)
-        return buffer.getvalue()
-    except Exception as e:
-        # If optimization fails, return original data
-        return image_data
+# Memory budget for upload data
+class MemoryBudget:
+    """Bounds the memory used by uploads at once, across all sessions and image worker processes.
+
+    Work reserves its estimated footprint before it starts and waits while
+    the budget is used up, so many simultaneous uploads queue instead of
+    exhausting memory. Decoding images is by far the largest share (see
+    optimize_image_files). A reservation larger than the whole budget is
+    granted once nothing else holds any, so it runs alone; a thread must
+    not wait for one reservation while holding another.
+    """
+    
+    def __init__(self, max_bytes):
+        self._condition = threading.Condition()
+        self.max_bytes = max_bytes
+        self.in_use = 0
+    
+    def acquire(self, nbytes):
+        with self._condition:
+            while self.in_use and self.in_use + nbytes > self.max_bytes:
+                self._condition.wait()
+            self.in_use += nbytes
+    
+    def release(self, nbytes):
+        with self._condition:
+            self.in_use -= nbytes
+            self._condition.notify_all()
     
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+@st.cache_resource
+def get_memory_budget():
+    """Create the process-wide upload memory budget"""
+    return MemoryBudget(UPLOAD_MEMORY_BUDGET_BYTES)
+
+# Image optimization in worker processes
+@st.cache_resource
+def get_image_process_pool():
+    """Create the process-wide pool used for image optimization.
+
+    Workers are forked. Spawn and forkserver workers cannot be used:
+    Streamlit installs this script as __main__, so each of those workers
+    would re-run the whole app, outbox and notifier threads included.
+
+    Forking copies only the calling thread, and any lock another thread
+    holds at that moment stays held in the worker. This is safe because a
+    worker only runs image_processing on its own files and queues, and
+    never takes the locks of this module's connections, pools or caches.
+    Python re-creates the import and logging locks after a fork. The
+    workers do no imports of their own, since every Pillow plugin is
+    loaded here first. Where fork is not available the pool is disabled
+    and images are optimized in-thread.
+    """
+    if IMAGE_PROCESS_WORKERS < 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    load_image_plugins()
+    return ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS, mp_context=multiprocessing.get_context('fork'))
+
+@st.cache_resource
+def get_optimized_image_cache():
+    """Open the process-wide on-disk cache of optimized images"""
+    return DiskLRUCache(OPTIMIZED_IMAGE_FOLDER, OPTIMIZED_IMAGE_CACHE_MAX_BYTES)
+
+def optimized_image_cache_key(input_path, options):
+    """Cache key for optimizing the file at input_path with `options`: its content hash plus a hash of the options"""
+    content_hash = hashlib.sha256()
+    with open(input_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            content_hash.update(chunk)
+    options_hash = hashlib.sha256(
+        json.dumps([OPTIMIZED_IMAGE_CACHE_VERSION, options], sort_keys=True).encode()
+    ).hexdigest()[:16]
+    return f"{content_hash.hexdigest()}-{options_hash}"
+
+def _read_cached_optimized_image(key, output_path):
+    """Write a cached optimized image to output_path and return its settings, or False on a miss"""
+    entry = get_optimized_image_cache().get(key)
+    if entry is None:
+        return False
+    # Entries are the settings as one line of JSON followed by the image bytes
+    header, _, data = entry.partition(b"\n")
+    with open(output_path, 'wb') as file:
+        file.write(data)
+    return json.loads(header)
+
+def _cache_optimized_image(key, output_path, settings):
+    with open(output_path, 'rb') as file:
+        data = file.read()
+    get_optimized_image_cache().put(key, json.dumps(settings).encode() + b"\n" + data)
+
+def optimize_image_files(jobs, **options):
+    """Optimize a batch of (input_path, output_path) image files across all worker processes.
+
+    `options` are passed to optimize_image_with_settings (e.g. max_bytes,
+    progressive). Results are cached on disk by content hash and options,
+    so retries and repeat uploads of the same image skip the work. If a
+    file cannot be optimized its original bytes are written to the output
+    path, so every output exists afterwards. Returns the settings chosen
+    for each file (None where the original was kept).
+    
+    Each file reserves its estimated decode size from the memory budget
+    until it is done, so large PNG and TIFF files (which cannot be decoded
+    at a reduced scale) wait rather than run in every worker at once.
+    """
+    pool = get_image_process_pool()
+    budget = get_memory_budget()
+    keys = []
+    futures = []
+    for input_path, output_path in jobs:
+        try:
+            key = optimized_image_cache_key(input_path, options)
+            cached = _read_cached_optimized_image(key, output_path)
+        except (OSError, ValueError):
+            key, cached = None, False
+        keys.append(key)
+        if cached is not False or not pool:
+            futures.append(cached if cached is not False else None)
+            continue
+        reserved = estimate_decode_bytes(input_path, **options)
+        budget.acquire(reserved)
+        try:
+            future = pool.submit(optimize_image_file, input_path, output_path, **options)
+        except BrokenProcessPool:
+            budget.release(reserved)
+            futures.append(None)
+            continue
+        future.add_done_callback(lambda _, reserved=reserved: budget.release(reserved))
+        futures.append(future)
+    
+    results = []
+    pool_broken = False
+    for (input_path, output_path), key, future in zip(jobs, keys, futures):
+        if isinstance(future, dict):
+            # Served from the cache
+            results.append(future)
+            continue
+        try:
+            if future is None:
+                with budget.reserve(estimate_decode_bytes(input_path, **options)):
+                    settings = optimize_image_file(input_path, output_path, **options)
+            else:
+                settings = future.result()
+        except Exception as e:
+            # Fall back to the original bytes
+            pool_broken = pool_broken or isinstance(e, BrokenProcessPool)
+            shutil.copyfile(input_path, output_path)
+            results.append(None)
+            continue
+        results.append(settings)
+        if settings is not None and key:
+            try:
+                _cache_optimized_image(key, output_path, settings)
+            except OSError:
+                pass
+    
+    if pool_broken:
+        # A worker died (e.g. out of memory); start a fresh pool for the next batch
+        get_image_process_pool.clear()
+    return results
+
 # Function to test database connection with retry logic
 def test_database_connection(max_retries=3, retry_delay=2):
     """Test database connection with retry logic"""
@@ -618,6 +2252,418 @@ def verify_password(password):
     """Verify if the provided password matches the admin password"""
     return password == ADMIN_PASSWORD
 
+# Slack notifications
+class SlackNotifier:
+    """Posts notifications to a Slack webhook from a background thread.
+
+    notify() only queues the text, so callers never wait on Slack.
+    Notifications arriving within `batch_window` seconds of each other are
+    joined into one post, posts are at least `min_interval` seconds apart,
+    and a throttled (429) post is retried after its Retry-After. When the
+    queue is full new notifications are dropped.
+    """
+    
+    def __init__(self, webhook_url, batch_window=SLACK_BATCH_WINDOW, min_interval=SLACK_MIN_INTERVAL,
+                 timeout=SLACK_TIMEOUT, max_queue=1000, max_batch=20, max_retries=3):
+        self.webhook_url = webhook_url
+        self.batch_window = batch_window
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self._queue = queue.Queue(maxsize=max_queue)
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def notify(self, text):
+        """Queue a notification; returns False if it was dropped"""
+        try:
+            self._queue.put_nowait(text)
+            return True
+        except queue.Full:
+            return False
+    
+    def _run(self):
+        last_post = 0
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            
+            time.sleep(max(0, last_post + self.min_interval - time.time()))
+            self._post("\n".join(batch))
+            last_post = time.time()
+    
+    def _post(self, text):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(self.webhook_url, json={"text": text}, timeout=self.timeout)
+            except requests.RequestException:
+                time.sleep(_retry_delay(None, attempt))
+                continue
+            if response.status_code != 429:
+                return
+            time.sleep(_retry_delay(response.headers.get('Retry-After'), attempt))
+
+@st.cache_resource
+def get_slack_notifier():
+    """Start the process-wide Slack notifier, or return None if no webhook is configured"""
+    return SlackNotifier(SLACK_WEBHOOK_URL) if SLACK_WEBHOOK_URL else None
+
+def notify_slack(text):
+    """Send a Slack notification in the background if a webhook URL is configured"""
+    notifier = get_slack_notifier()
+    if notifier:
+        notifier.notify(text)
+
+# Background outbox for email and SharePoint jobs
+class Outbox:
+    """Durable queue of upload jobs, stored in SQLite and delivered by background threads.
+
+    Each job's files are staged in its own folder under OUTBOX_FOLDER
+    before the job is queued, so jobs survive an app restart; jobs that
+    were running when the process stopped are queued again. `handlers`
+    maps a job kind to a function (job_id, payload) -> (message, error,
+    payload). An error retries the job with exponential backoff, up to
+    OUTBOX_MAX_ATTEMPTS times. The returned payload replaces the stored
+    one, so progress such as emails already sent is kept across retries.
+    A handler can list the files its last attempt failed on in the
+    payload's 'failures' as [file_name, error] pairs; jobs() returns them.
+    
+    Jobs queued with a `group` can be coalesced: a job held back for
+    `hold` seconds absorbs later jobs of the same kind and group until it
+    is first attempted (see enqueue).
+    """
+    
+    def __init__(self, db_path, folder, handlers, workers=OUTBOX_WORKERS):
+        self.folder = folder
+        self.handlers = handlers
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        os.makedirs(folder, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox_jobs (
+            job_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            title TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            message TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            group_key TEXT,
+            merged_job_ids TEXT NOT NULL DEFAULT '[]'
+        )
+        """)
+        if 'group_key' not in {row[1] for row in self._conn.execute("PRAGMA table_info(outbox_jobs)")}:
+            # Outboxes created before jobs could be coalesced
+            self._conn.execute("ALTER TABLE outbox_jobs ADD COLUMN group_key TEXT")
+            self._conn.execute("ALTER TABLE outbox_jobs ADD COLUMN merged_job_ids TEXT NOT NULL DEFAULT '[]'")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_jobs_due ON outbox_jobs (status, next_attempt_at)")
+        # Jobs interrupted by a restart are delivered again
+        self._conn.execute("UPDATE outbox_jobs SET status = 'queued' WHERE status = 'running'")
+        self._conn.commit()
+        self._purge()
+        
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+    
+    def new_job(self):
+        """Return (job_id, folder) for a job whose files are about to be staged"""
+        job_id = uuid.uuid4().hex
+        job_folder = os.path.join(self.folder, job_id)
+        os.makedirs(job_folder)
+        return job_id, job_folder
+    
+    def enqueue(self, job_id, kind, title, payload, group=None, hold=0, merge=None):
+        """Queue a job once its files are staged; it is delivered in the background.
+
+        With `group`, if a job of the same kind and group is still waiting
+        for its first attempt, this one is merged into it instead:
+        merge(queued_payload, payload) returns (payload, title, flush), and
+        flush=True sends the merged job right away. Otherwise the new job
+        waits `hold` seconds for others to join. Returns the ID of the job
+        that will deliver the files.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                """SELECT job_id, payload, merged_job_ids, next_attempt_at FROM outbox_jobs
+                WHERE kind = ? AND group_key = ? AND status = 'queued' AND attempts = 0
+                ORDER BY created_at LIMIT 1""",
+                (kind, group)
+            ).fetchone() if group is not None and merge else None
+            
+            if row:
+                target_id, queued_payload, merged_job_ids, next_attempt_at = row
+                payload, title, flush = merge(json.loads(queued_payload), payload)
+                self._conn.execute(
+                    """UPDATE outbox_jobs SET title = ?, payload = ?, merged_job_ids = ?, next_attempt_at = ?, updated_at = ?
+                    WHERE job_id = ?""",
+                    (title, json.dumps(payload), json.dumps(json.loads(merged_job_ids) + [job_id]),
+                     now if flush else next_attempt_at, now, target_id)
+                )
+            else:
+                target_id = job_id
+                self._conn.execute(
+                    """INSERT INTO outbox_jobs
+                    (job_id, kind, title, payload, status, attempts, next_attempt_at, created_at, updated_at, group_key)
+                    VALUES (?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?)""",
+                    (job_id, kind, title, json.dumps(payload), now + hold, now, now, group)
+                )
+            self._conn.commit()
+        with self._wakeup:
+            self._wakeup.notify()
+        return target_id
+    
+    def jobs(self, job_ids):
+        """Return {'job_id', 'title', 'status', 'message', 'attempts', 'failures'} for the given jobs, oldest first"""
+        if not job_ids:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                f"""SELECT job_id, title, status, message, attempts, payload FROM outbox_jobs
+                WHERE job_id IN ({', '.join('?' * len(job_ids))}) ORDER BY created_at""",
+                list(job_ids)
+            ).fetchall()
+        return [
+            {**dict(zip(['job_id', 'title', 'status', 'message', 'attempts'], row[:5])),
+             'failures': json.loads(row[5]).get('failures', [])}
+            for row in rows
+        ]
+    
+    def _claim(self):
+        """Mark the oldest due job as running and return (job_id, kind, payload, attempts), or None"""
+        with self._lock:
+            while True:
+                row = self._conn.execute(
+                    """SELECT job_id, kind, payload, attempts FROM outbox_jobs
+                    WHERE status = 'queued' AND next_attempt_at <= ? ORDER BY created_at LIMIT 1""",
+                    (time.time(),)
+                ).fetchone()
+                if row is None:
+                    return None
+                # Another process sharing the database may have claimed it since the SELECT
+                claimed = self._conn.execute(
+                    """UPDATE outbox_jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+                    WHERE job_id = ? AND status = 'queued'""",
+                    (time.time(), row[0])
+                ).rowcount
+                self._conn.commit()
+                if claimed:
+                    return row[0], row[1], json.loads(row[2]), row[3] + 1
+    
+    def _finish(self, job_id, attempts, message, error, payload):
+        now = time.time()
+        if error is None:
+            status, next_attempt_at = 'done', now
+        elif attempts >= OUTBOX_MAX_ATTEMPTS:
+            status, next_attempt_at, message = 'failed', now, error
+        else:
+            delay = min(30 * 60, OUTBOX_RETRY_DELAY * 2 ** (attempts - 1))
+            status, next_attempt_at, message = 'queued', now + delay, f"Retrying in {delay} s: {error}"
+        with self._lock:
+            self._conn.execute(
+                """UPDATE outbox_jobs SET status = ?, payload = ?, message = ?, next_attempt_at = ?, updated_at = ?
+                WHERE job_id = ?""",
+                (status, json.dumps(payload), message, next_attempt_at, now, job_id)
+            )
+            self._conn.commit()
+        if status == 'done':
+            for folder_job_id in [job_id] + self._merged_job_ids(job_id):
+                shutil.rmtree(os.path.join(self.folder, folder_job_id), ignore_errors=True)
+    
+    def _merged_job_ids(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT merged_job_ids FROM outbox_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else []
+    
+    def _work(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                # Woken by enqueue, or on timeout to pick up retries that became due
+                with self._wakeup:
+                    self._wakeup.wait(timeout=5)
+                continue
+            
+            job_id, kind, payload, attempts = job
+            try:
+                message, error, payload = self.handlers[kind](job_id, payload)
+            except Exception as e:
+                message, error = None, f"Error delivering job: {str(e)}"
+            self._finish(job_id, attempts, message, error, payload)
+    
+    def _purge(self):
+        """Forget finished jobs past OUTBOX_RETENTION_DAYS and remove folders no queued job owns"""
+        cutoff = time.time() - OUTBOX_RETENTION_DAYS * 86400
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM outbox_jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,)
+            )
+            self._conn.commit()
+            known = set()
+            for job_id, merged_job_ids in self._conn.execute(
+                "SELECT job_id, merged_job_ids FROM outbox_jobs WHERE status != 'done'"
+            ):
+                known.update([job_id] + json.loads(merged_job_ids))
+        for entry in os.scandir(self.folder):
+            # Folders of jobs never queued (e.g. the app stopped while staging) are kept a day
+            if entry.name not in known and entry.stat().st_mtime < time.time() - 86400:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+def map_file(file_path):
+    """Map a staged file read-only, so it can be passed around like bytes without being read into memory"""
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def deliver_email_job(job_id, payload):
+    """Optimize a Procore job's images and email them to the project address.
+
+    payload: recipient_email, project_id, status, files (name, source,
+    attachment, photo_hash) and the indices of files already delivered.
+    """
+    files = payload['files']
+    pending = [index for index in range(len(files)) if index not in payload['delivered']]
+    
+    # Optimize all images in parallel across worker processes. Each gets an even share of a full
+    # message, so a batch packs into as few emails as plan_email_messages can manage
+    optimize_jobs = [index for index in pending if files[index]['source'] != files[index]['attachment']]
+    per_message = min(len(pending), EMAIL_MAX_ATTACHMENTS)
+    settings = optimize_image_files(
+        [(files[index]['source'], files[index]['attachment']) for index in optimize_jobs],
+        max_bytes=email_image_budget(0, per_message), progressive=EMAIL_PROGRESSIVE_JPEG, transcode=True
+    )
+    attachments = {index: files[index]['attachment'] for index in pending}
+    for index, image_settings in zip(optimize_jobs, settings):
+        # TIFF and BMP images are transcoded; give them a matching extension
+        new_path = output_file_name(attachments[index], image_settings)
+        if new_path != attachments[index]:
+            os.replace(attachments[index], new_path)
+            attachments[index] = new_path
+    
+    # Large batches are split across several emails, sent in parallel
+    status = payload['status']
+    messages, errors = send_email_messages(
+        payload['recipient_email'], status, f"<p>{status}</p>", [attachments[index] for index in pending]
+    )
+    delivered = {file_path for message, error in zip(messages, errors) if error is None for file_path in message}
+    newly_delivered = [index for index in pending if attachments[index] in delivered]
+    payload['delivered'].extend(newly_delivered)
+    get_photo_hash_index().record(
+        f"project:{payload['project_id']}", [(files[index]['name'], files[index]['photo_hash']) for index in newly_delivered]
+    )
+    
+    # Record every file that was not delivered, so the status list can show what to resend
+    names = {attachments[index]: files[index]['name'] for index in pending}
+    payload['failures'] = [
+        [names[file_path], error] for message, error in zip(messages, errors) if error for file_path in message
+    ]
+    failed = [error for error in errors if error]
+    if failed:
+        return None, f"{len(failed)} of {len(messages)} emails failed to send: {failed[0]}", payload
+    
+    # Log to Slack if webhook URL is configured
+    notify_slack(f"Images for Project ID: {payload['project_id']} with status '{status}' sent to {payload['recipient_email']}")
+    
+    emails = f" in {len(messages)} emails" if len(messages) > 1 else ""
+    return f"Sent {len(files)} file(s) to {payload['recipient_email']}{emails}", None, payload
+
+def email_job_title(payload):
+    return f"Project {payload['project_id']} · {payload['status']} · {len(payload['files'])} file(s)"
+
+def email_digest_full(files):
+    """True once held Procore submissions reach EMAIL_DIGEST_MAX_FILES or EMAIL_DIGEST_MAX_BYTES and should be sent"""
+    staged_bytes = sum(os.path.getsize(item['source']) for item in files)
+    return len(files) >= EMAIL_DIGEST_MAX_FILES or staged_bytes >= EMAIL_DIGEST_MAX_BYTES
+
+def merge_email_jobs(queued_payload, payload):
+    """Add a Procore submission to a held one for the same project and status (see Outbox.enqueue)"""
+    merged = {**queued_payload, 'files': queued_payload['files'] + payload['files']}
+    return merged, email_job_title(merged), email_digest_full(merged['files'])
+
+def deliver_sharepoint_job(job_id, payload):
+    """Upload a Shopify job's images to CustomerName/Status/OrderID in SharePoint.
+
+    payload: order_id, folder_path, files (name, source, photo_hash) and
+    the indices of files whose hashes were already recorded. Files
+    uploaded by an earlier attempt are skipped by the upload index.
+    """
+    access_token, error = get_sharepoint_access_token()
+    if error:
+        return None, error, payload
+    drive_id, error = get_shopify_orders_drive_id(access_token)
+    if error:
+        return None, error, payload
+    
+    files = payload['files']
+    results, error = upload_files_to_sharepoint_folder(
+        access_token, drive_id, payload['folder_path'], [(item['name'], map_file(item['source'])) for item in files]
+    )
+    if error:
+        return None, error, payload
+    
+    uploaded = [index for index, (_, web_url, _, _) in enumerate(results) if web_url and index not in payload['recorded']]
+    payload['recorded'].extend(uploaded)
+    get_photo_hash_index().record(
+        f"order:{payload['order_id']}", [(files[index]['name'], files[index]['photo_hash']) for index in uploaded]
+    )
+    
+    payload['failures'] = [[file_name, upload_error] for file_name, _, upload_error, _ in results if upload_error]
+    if payload['failures']:
+        return None, f"{len(payload['failures'])} of {len(results)} image(s) failed to upload", payload
+    
+    notify_slack(f"{len(results)} image(s) for Order ID: {payload['order_id']} uploaded to SharePoint folder {payload['folder_path']}")
+    
+    message = f"Uploaded {len(results)} image(s) to {payload['folder_path']}"
+    bytes_saved = sum(saved for _, _, _, saved in results)
+    if bytes_saved > 0:
+        message += f", saving {bytes_saved / 1024 / 1024:.1f} MB of SharePoint storage"
+    return message, None, payload
+
+@st.cache_resource
+def get_outbox():
+    """Open the process-wide outbox and start its delivery threads"""
+    return Outbox(OUTBOX_DB, OUTBOX_FOLDER, {'email': deliver_email_job, 'sharepoint': deliver_sharepoint_job})
+
+def queue_job(job_id, kind, title, payload, **options):
+    """Queue an outbox job and remember it for this session's delivery list.
+
+    `options` are passed to Outbox.enqueue. Returns the ID of the job that
+    will deliver the files, which differs from job_id if it was merged.
+    """
+    target_id = get_outbox().enqueue(job_id, kind, title, payload, **options)
+    if target_id not in st.session_state.setdefault('outbox_jobs', []):
+        st.session_state.outbox_jobs.append(target_id)
+    return target_id
+
+@st.fragment(run_every=OUTBOX_STATUS_REFRESH)
+def show_outbox_status():
+    """Show how this session's queued uploads are doing, refreshed in place"""
+    jobs = get_outbox().jobs(st.session_state.get('outbox_jobs', [])[-10:])
+    if not jobs:
+        return
+    
+    st.subheader("Deliveries")
+    labels = {'queued': ("⏳", "Queued"), 'running': ("🔄", "Sending..."), 'done': ("✅", "Done"), 'failed': ("❌", "Failed")}
+    for job in reversed(jobs):
+        icon, label = labels[job['status']]
+        st.write(f"{icon} {job['title']}: {job['message'] or label}")
+        # List the files that failed so the user knows what to resend if the job gives up
+        if job['status'] != 'done':
+            for file_name, error in job['failures']:
+                st.write(f"- {file_name}: {error}")
+
 def upload_images_tab():
     # Initialize session state variables if they don't exist
     if 'form_submitted' not in st.session_state:
@@ -674,65 +2720,71 @@ def upload_images_tab():
         type=list(ALLOWED_EXTENSIONS),
         key=file_uploader_key
     )
+    if uploaded_files:
+        show_image_previews(uploaded_files)
     
     # Only show Send Images button if both Project ID and Status are selected (not blank)
     if project_id and status and uploaded_files:
+        duplicates, hashes = flag_near_duplicates(f"project:{project_id}", uploaded_files)
+        skip_duplicates = bool(duplicates) and st.checkbox(
+            "Skip near-duplicate photos", value=True, key=f"{st.session_state.form_key_prefix}_skip_duplicates"
+        )
+        
         if st.button("Send Images"):
             recipient_email = get_email_for_project(project_id)
             
             if not recipient_email:
                 st.error(f"No email found for Project ID: {project_id}")
             else:
-                # Save uploaded files
-                saved_files = []
-                for uploaded_file in uploaded_files:
+                # Drop near-duplicates before any optimization work is done
+                sent = [index for index in range(len(uploaded_files)) if not (skip_duplicates and index in duplicates)]
+                
+                # Stage uploaded files in the job's folder; optimizing and sending happen in the background
+                job_id, job_folder = get_outbox().new_job()
+                files = []
+                for index in sent:
+                    uploaded_file = uploaded_files[index]
                     # Create a unique filename with status prefix
                     file_extension = os.path.splitext(uploaded_file.name)[1]
-                    unique_filename = f"{status}_{uuid.uuid4()}{file_extension}"
-                    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
+                    attachment_path = os.path.join(job_folder, f"{status}_{uuid.uuid4()}{file_extension}")
                     
-                    # Only optimize images, not PDFs
-                    if file_extension.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']:
-                        # Optimize image before saving
-                        optimized_data = optimize_image(uploaded_file.getbuffer())
-                        with open(file_path, "wb") as f:
-                            f.write(optimized_data)
+                    # Only optimize images, not PDFs; the optimized image is written to attachment_path
+                    if file_extension.lower() in OPTIMIZABLE_IMAGE_EXTENSIONS:
+                        source_path = f"{attachment_path}.original"
                     else:
-                        # Save non-image files as-is
-                        with open(file_path, "wb") as f:
-                            f.write(uploaded_file.getbuffer())
+                        source_path = attachment_path
+                    with open(source_path, "wb") as f:
+                        f.write(uploaded_file.getbuffer())
                     
-                    saved_files.append(file_path)
+                    files.append({
+                        'name': uploaded_file.name, 'source': source_path, 'attachment': attachment_path,
+                        'photo_hash': hashes[index]
+                    })
                 
-                # Send email with attachments
-                subject = f"{status}"
-                body = f"<p>{status}</p>"
+                payload = {
+                    'recipient_email': recipient_email, 'project_id': project_id, 'status': status,
+                    'files': files, 'delivered': []
+                }
+                # In digest mode, submissions for the same project and status within the window go out as one email
+                hold = EMAIL_DIGEST_WINDOW if EMAIL_DIGEST_WINDOW > 0 and not email_digest_full(files) else 0
+                target_id = queue_job(
+                    job_id, 'email', email_job_title(payload), payload,
+                    group=json.dumps([project_id, status, recipient_email]) if EMAIL_DIGEST_WINDOW > 0 else None,
+                    hold=hold, merge=merge_email_jobs
+                )
                 
-                if send_email(recipient_email, subject, body, saved_files):
-                    # Set flag to reset form on next rerun
-                    st.session_state.form_submitted = True
-                    st.success("Images sent successfully!")
-                    
-                    # Log to Slack if webhook URL is configured
-                    if SLACK_WEBHOOK_URL:
-                        try:
-                            slack_message = {
-                                "text": f"Images for Project ID: {project_id} with status '{status}' sent to {recipient_email}"
-                            }
-                            requests.post(SLACK_WEBHOOK_URL, json=slack_message)
-                        except Exception as e:
-                            st.warning(f"Could not send Slack notification: {e}")
-                    
-                    # Force a rerun to reset the form immediately
-                    time.sleep(1)  # Give user time to see the success message
-                    st.rerun()
+                # Set flag to reset form on next rerun
+                st.session_state.form_submitted = True
+                # Toasts stay up across the rerun, so there is no need to wait before resetting the form
+                if target_id != job_id:
+                    st.toast(f"Images added to the {status} email already queued for this project!", icon="✅")
+                elif hold:
+                    st.toast(f"Images queued! They will be sent within {hold} seconds, with any others for this project and status.", icon="✅")
                 else:
-                    st.error("Failed to send email. Please check the logs.")
-                    
-                    # Clean up files if email failed
-                    for file_path in saved_files:
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
+                    st.toast("Images queued for sending!", icon="✅")
+                
+                # Force a rerun to reset the form immediately
+                st.rerun()
 
 def manage_projects_tab():
     st.header("Project Management")
@@ -958,67 +3010,107 @@ def shopify_upload_tab():
                 key=file_uploader_key
             )
             
+            if selected_status and st.checkbox("Show photos already uploaded", key=f"{file_uploader_key}_gallery"):
+                access_token, error = get_sharepoint_access_token()
+                if not error:
+                    drive_id, error = get_shopify_orders_drive_id(access_token)
+                if error:
+                    st.error(error)
+                else:
+                    show_order_photo_gallery(access_token, drive_id, f"{customer_name}/{selected_status}/{selected_order_id}")
+            
             if uploaded_files:
+                show_image_previews(uploaded_files)
+                duplicates, hashes = flag_near_duplicates(f"order:{selected_order_id}", uploaded_files)
+                skip_duplicates = bool(duplicates) and st.checkbox(
+                    "Skip near-duplicate photos", value=True, key=f"{file_uploader_key}_skip_duplicates"
+                )
+                
                 if st.button("Upload to SharePoint", type="primary"):
-                    # Simple and fast SharePoint upload
-                    with st.spinner("Uploading images..."):
-                        try:
-                            # Get SharePoint access token
-                            access_token, error = get_sharepoint_access_token()
-                            if error:
-                                st.error("Upload failed. Please try again.")
-                                return
-                            
-                            # Get the Shopify_orders_photos drive ID
-                            drive_id, error = get_shopify_orders_drive_id(access_token)
-                            if error:
-                                st.error("Upload failed. Please try again.")
-                                return
-                            
-                            # Create folder path: CustomerName/Status/OrderID
-                            folder_path = f"{customer_name}/{selected_status}/{selected_order_id}"
-                            folder_id, error = get_or_create_folder_path(access_token, drive_id, folder_path)
-                            if error:
-                                st.error("Upload failed. Please try again.")
-                                return
-                            
-                            # Upload all files
-                            successful_count = 0
-                            failed_count = 0
-                            
-                            for uploaded_file in uploaded_files:
-                                file_content = uploaded_file.getvalue()
-                                success, error = upload_file_content_to_sharepoint(
-                                    access_token, 
-                                    drive_id, 
-                                    folder_id, 
-                                    uploaded_file.name, 
-                                    file_content
-                                )
-                                
-                                if success:
-                                    successful_count += 1
-                                else:
-                                    failed_count += 1
-                            
-                            # Show only one simple success message
-                            if successful_count > 0:
-                                st.success(f"✅ Successfully uploaded {successful_count} image(s)!")
-                                # Set flag to reset form on next rerun
-                                st.session_state.shopify_form_submitted = True
-                                # Give user time to see the success message
-                                time.sleep(1)
-                                # Force a rerun to reset the form
-                                st.rerun()
-                            else:
-                                st.error("❌ Upload failed. Please try again.")
-                            
-                        except Exception as e:
-                            st.error("❌ Upload failed. Please try again.")
+                    # Near-duplicates are dropped before they are optimized or transferred
+                    sent = [index for index in range(len(uploaded_files)) if not (skip_duplicates and index in duplicates)]
+                    
+                    # Stage the files in the job's folder; the upload happens in the background
+                    job_id, job_folder = get_outbox().new_job()
+                    files = []
+                    for position, index in enumerate(sent):
+                        source_path = os.path.join(job_folder, f"{position}_{uuid.uuid4()}")
+                        with open(source_path, "wb") as f:
+                            f.write(uploaded_files[index].getbuffer())
+                        files.append({'name': uploaded_files[index].name, 'source': source_path, 'photo_hash': hashes[index]})
+                    
+                    # Files go into CustomerName/Status/OrderID
+                    folder_path = f"{customer_name}/{selected_status}/{selected_order_id}"
+                    queue_job(job_id, 'sharepoint', f"Order {selected_order_id} · {selected_status} · {len(files)} image(s)", {
+                        'order_id': selected_order_id, 'folder_path': folder_path, 'files': files, 'recorded': []
+                    })
+                    
+                    # Toasts stay up across the rerun, so there is no need to wait before resetting the form
+                    st.toast(f"Queued {len(files)} image(s) for upload!", icon="✅")
+                    # Set flag to reset form on next rerun
+                    st.session_state.shopify_form_submitted = True
+                    # Force a rerun to reset the form
+                    st.rerun()
         else:
             st.error(f"Customer not found for OrderID: {selected_order_id}")
 
+def sharepoint_tools_sidebar():
+    """Admin tools for the Shopify_orders_photos library, shown in the sidebar"""
+    with st.sidebar.expander("SharePoint Tools"):
+        if not st.session_state.get('admin_authenticated'):
+            password = st.text_input("Admin password", type="password", key="sharepoint_tools_password")
+            if not password:
+                return
+            if not verify_password(password):
+                st.error("Incorrect password")
+                return
+            st.session_state.admin_authenticated = True
+        
+        upload_stats = get_upload_index().stats()
+        st.caption(
+            f"Duplicate upload index: {upload_stats['hits']} skipped, "
+            f"{upload_stats['misses']} uploaded, {upload_stats['entries']} files tracked"
+        )
+        
+        if st.button("Sync library mirror"):
+            with st.spinner("Syncing..."):
+                access_token, error = get_sharepoint_access_token()
+                if not error:
+                    drive_id, error = get_shopify_orders_drive_id(access_token)
+                if not error:
+                    changed, error = sync_drive_mirror(access_token, drive_id, force=True)
+                if error:
+                    st.error(error)
+                else:
+                    st.success(f"✅ {changed} change(s) applied")
+        
+        if st.button("Photos per order"):
+            access_token, error = get_sharepoint_access_token()
+            if not error:
+                drive_id, error = get_shopify_orders_drive_id(access_token)
+            if not error:
+                _, error = sync_drive_mirror(access_token, drive_id)
+            if error:
+                st.error(error)
+            else:
+                st.dataframe(get_drive_mirror().photos_per_order(drive_id), use_container_width=True)
+        
+        if st.button("Pre-create order folders"):
+            with st.spinner("Creating folders..."):
+                access_token, error = get_sharepoint_access_token()
+                if not error:
+                    drive_id, error = get_shopify_orders_drive_id(access_token)
+                if error:
+                    st.error(error)
+                    return
+                
+                resolved, errors = precreate_shopify_order_folders(access_token, drive_id)
+                st.success(f"✅ {resolved} folder(s) created or found")
+                for error in errors[:10]:
+                    st.warning(error)
+
 def main():
+    show_logo()
     st.title("Project Image Upload System")
     
     # Add database status indicator in sidebar
@@ -1033,6 +3125,7 @@ def main():
     
     # Initialize application
     init_database()
+    sharepoint_tools_sidebar()
     
     # Create tabs with only two tabs (removed Manage Projects tab)
     tab1, tab2 = st.tabs(["Procore Projects", "Shopify Orders"])
@@ -1042,6 +3135,8 @@ def main():
     
     with tab2:
         shopify_upload_tab()
+    
+    show_outbox_status()
 
 if __name__ == "__main__":
     main()